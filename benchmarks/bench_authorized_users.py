@@ -0,0 +1,49 @@
+"""
+Micro-benchmark for the per-message authorization check.
+
+Compares re-reading authorized_users.json on every message (the old behaviour)
+with the in-memory registry in handlers.load_authorized_users.
+
+Usage: python benchmarks/bench_authorized_users.py [user_count] [iterations]
+"""
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import handlers
+
+
+def read_file_every_time():
+    with open(config.USER_DATA_FILE, 'r') as f:
+        return set(json.load(f))
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        user_file = os.path.join(tmp_dir, "authorized_users.json")
+        with open(user_file, 'w') as f:
+            json.dump(list(range(user_count)), f)
+        config.USER_DATA_FILE = user_file
+        handlers.USER_DATA_FILE = user_file
+        handlers.reload_authorized_users()
+
+        probe = user_count - 1
+        old = timeit.timeit(lambda: probe in read_file_every_time(), number=iterations)
+        new = timeit.timeit(lambda: handlers.is_authorized_user(probe), number=iterations)
+
+    print(f"users={user_count} iterations={iterations}")
+    print(f"file per message : {old / iterations * 1e6:10.2f} us/message")
+    print(f"cached registry  : {new / iterations * 1e6:10.2f} us/message")
+    print(f"speedup          : {old / new:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
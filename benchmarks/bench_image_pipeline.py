@@ -0,0 +1,75 @@
+"""
+Benchmark for preparing Telegram photos for Gemini.
+
+Compares the old pipeline (decode, convert and re-encode at full resolution)
+with images._to_jpeg, which passes small JPEGs through and decodes large ones
+at reduced scale, for typical Telegram photo sizes. Then compares the bytes
+downloaded and the preprocessing time for the size images.select_photo_size
+picks from Telegram's usual sizes of one photo (320, 800, 1280 and 2560 pixels)
+against always downloading the original.
+
+Usage: python benchmarks/bench_image_pipeline.py [max_side] [runs]
+"""
+import io
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from images import _to_jpeg, select_photo_size
+
+MAX_SIDE = int(sys.argv[1]) if len(sys.argv) > 1 else 1536
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+
+def make_photo(width, height):
+    image = Image.effect_mandelbrot((width, height), (-2.0, -1.2, 0.8, 1.2), 100).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=87)
+    return buffer.getvalue()
+
+
+def run_old(data):
+    image = Image.open(io.BytesIO(data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def run_new(data):
+    image_bytes, _, _ = _to_jpeg(data, MAX_SIDE)
+    return data if image_bytes is None else image_bytes
+
+
+def timed(func, data):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        result = func(data)
+    return (time.perf_counter() - start) / RUNS, len(result)
+
+
+def main():
+    print(f"max_side={MAX_SIDE} runs={RUNS}")
+    print(f"{'photo':>11} {'input':>9} {'old':>10} {'old out':>9} {'new':>10} {'new out':>9}")
+    for width, height in ((1280, 960), (2560, 1920), (4096, 3072)):
+        data = make_photo(width, height)
+        old, old_size = timed(run_old, data)
+        new, new_size = timed(run_new, data)
+        print(f"{width:>5}x{height:<5} {len(data):>9} {old * 1000:>8.1f}ms {old_size:>9} {new * 1000:>8.1f}ms {new_size:>9}")
+
+    # Telegram's sizes of a 4:3 photo, as in message.photo
+    sizes = [SimpleNamespace(width=side, height=side * 3 // 4, data=make_photo(side, side * 3 // 4))
+             for side in (320, 800, 1280, 2560)]
+    print(f"\n{'download':>9} {'photo':>11} {'bytes':>9} {'prepare':>10} {'upload':>9}")
+    for label, photo in (("original", sizes[-1]), ("selected", select_photo_size(sizes, MAX_SIDE))):
+        prepared, size = timed(run_new, photo.data)
+        print(f"{label:>9} {photo.width:>5}x{photo.height:<5} {len(photo.data):>9} {prepared * 1000:>8.1f}ms {size:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark for rendering streamed responses to MarkdownV2.
+
+Compares escaping the whole accumulated text on every update (the old
+behaviour) with streaming.StreamRenderer, for responses of 4k to 64k chars.
+
+Usage: python benchmarks/bench_stream_render.py [chunk_size] [chunks_per_update]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from md2tgmd import escape
+from streaming import StreamRenderer
+
+PARAGRAPHS = [
+    "## Section title\n\n",
+    "Some **bold** text, a_snake_case name, 3.14 and (parentheses) with a [link](https://example.com).\n\n",
+    "* first item\n* second item with `inline code`\n\n",
+    "```python\ndef f(x):\n\n    return x * 2  # a comment.\n```\n\n",
+    "1. numbered\n2. list!\n\n",
+    "> a quoted line\n\n",
+]
+
+
+def make_text(length):
+    parts, size, i = [], 0, 0
+    while size < length:
+        paragraph = PARAGRAPHS[i % len(PARAGRAPHS)]
+        parts.append(paragraph)
+        size += len(paragraph)
+        i += 1
+    return "".join(parts)[:length]
+
+
+def run_old(chunks, chunks_per_update):
+    full_response = ""
+    for i, chunk in enumerate(chunks, 1):
+        full_response += chunk
+        if i % chunks_per_update == 0:
+            escape(full_response)
+    return escape(full_response)
+
+
+def run_new(chunks, chunks_per_update):
+    renderer = StreamRenderer()
+    for i, chunk in enumerate(chunks, 1):
+        renderer.append(chunk)
+        if i % chunks_per_update == 0:
+            renderer.render()
+    return renderer.final()
+
+
+def main():
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+    chunks_per_update = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    print(f"chunk_size={chunk_size} chunks_per_update={chunks_per_update}")
+    print(f"{'length':>8} {'full escape':>14} {'incremental':>14} {'speedup':>8}")
+    for length in (4096, 8192, 16384, 32768, 65536):
+        text = make_text(length)
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+        start = time.perf_counter()
+        run_old(chunks, chunks_per_update)
+        old = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_new(chunks, chunks_per_update)
+        new = time.perf_counter() - start
+
+        print(f"{length:>8} {old * 1000:>12.1f}ms {new * 1000:>12.1f}ms {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Time-to-first-token benchmark for gemini_stream_switchable with simulated latencies.
+
+A fake Telegram bot and a fake Gemini client add fixed round-trip delays. The
+time from the incoming message to the first visible token is measured twice
+with the same fakes: once as the bot runs, with the placeholder reply and the
+model request overlapping, and once sequentially, with the fake model request
+held until the placeholder has been sent, as the bot did before.
+
+Usage: python benchmarks/bench_ttft.py [telegram_latency_s] [model_latency_s] [runs]
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini
+
+TELEGRAM_LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.15
+MODEL_LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.4
+RUNS = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+
+class FakeBot:
+    def __init__(self):
+        self.first_token_at = None
+        self.placeholder_sent = asyncio.Event()
+
+    async def reply_to(self, message, text, **kwargs):
+        await asyncio.sleep(TELEGRAM_LATENCY)
+        self.placeholder_sent.set()
+        return SimpleNamespace(chat=message.chat, message_id=1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(TELEGRAM_LATENCY)
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=2)
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+
+def make_chunk(text):
+    part = SimpleNamespace(text=text, executable_code=None, code_execution_result=None)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))], usage_metadata=None)
+
+
+class FakeChat:
+    # Set to an event to hold the model request until it is set (sequential mode)
+    start_after = None
+
+    def get_history(self, curated=False):
+        return []
+
+    async def send_message_stream(self, message):
+        if FakeChat.start_after is not None:
+            await FakeChat.start_after.wait()
+        await asyncio.sleep(MODEL_LATENCY)
+
+        async def stream():
+            for word in ("Hello", " world"):
+                yield make_chunk(word)
+        return stream()
+
+
+class FakeClient:
+    def __init__(self):
+        chats = SimpleNamespace(create=lambda **kwargs: FakeChat())
+        self.aio = SimpleNamespace(chats=chats, aclose=self.aclose)
+
+    async def aclose(self):
+        pass
+
+
+async def run_once(user_id, sequential=False):
+    bot = FakeBot()
+    FakeChat.start_after = bot.placeholder_sent if sequential else None
+    message = SimpleNamespace(from_user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=user_id, type="private"))
+    start = time.monotonic()
+    await gemini.gemini_stream_switchable(bot, message, "hi", gemini.model_2)
+    return bot.first_token_at - start
+
+
+async def main():
+    gemini._create_client = lambda key: FakeClient()
+    gemini.api_keys.append("benchmark-key")
+    await gemini.initialize_client()
+
+    sequential = [await run_once(i, sequential=True) for i in range(RUNS)]
+    overlapped = [await run_once(RUNS + i) for i in range(RUNS)]
+    print(f"telegram={TELEGRAM_LATENCY * 1000:.0f}ms model={MODEL_LATENCY * 1000:.0f}ms runs={RUNS}")
+    print(f"sequential: {sum(sequential) / RUNS * 1000:8.1f}ms")
+    print(f"overlapped: {sum(overlapped) / RUNS * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -14,6 +14,8 @@ lang_settings = {
         "gemini_prompt_help": "请在 /gemini 后添加您想说的内容。\n例如：`/gemini 谁是约翰列侬？`",
         "gemini_pro_prompt_help": "请在 /gemini_pro 后添加您想说的内容。\n例如：`/gemini_pro 谁是约翰列侬？`",
         "history_cleared": "您的聊天历史已清除",
+        "busy": "🤖 当前请求过多，请稍后再试。",
+        "busy_user": "⏳ 您还有请求在排队，请等它们完成后再发送。",
         "private_chat_only": "此命令仅适用于私人聊天！",
         "now_using_model": "现在您正在使用",
         "send_photo_prompt": "请发送一张照片",
@@ -65,7 +67,8 @@ lang_settings = {
         "error_details": "错误详情：",
         "switching_api_key": "正在切换密钥...",
         "no_candidates_generated": "模型未能生成任何内容。",
-        "describe_image_prompt": "描述这张图片"
+        "describe_image_prompt": "描述这张图片",
+        "continued_answer": "🤖 继续生成..."
     },
     "en": {
         "error_info": "⚠️⚠️⚠️\nSomething went wrong!\nPlease try to change your prompt or contact the admin!",
@@ -75,6 +78,8 @@ lang_settings = {
         "gemini_prompt_help": "Please add what you want to say after /gemini.\nFor example: `/gemini Who is john lennon?`",
         "gemini_pro_prompt_help": "Please add what you want to say after /gemini_pro.\nFor example: `/gemini_pro Who is john lennon?`",
         "history_cleared": "Your history has been cleared",
+        "busy": "🤖 Too many requests right now, please try again in a moment.",
+        "busy_user": "⏳ You already have requests waiting, please send more once they are answered.",
         "private_chat_only": "This command is only for private chat!",
         "now_using_model": "Now you are using",
         "send_photo_prompt": "Please send a photo",
@@ -126,14 +131,114 @@ lang_settings = {
         "error_details": "Error details: ",
         "switching_api_key": "Switching API key...",
         "no_candidates_generated": "The model failed to generate any content.",
-        "describe_image_prompt": "Describe this image"
+        "describe_image_prompt": "Describe this image",
+        "continued_answer": "🤖 Continuing..."
     }
 }
 
 conf = {
     "default_language": "zh",
+    # Streaming edits: the first update is sent immediately, then the interval per chat
+    # grows from streaming_update_interval by streaming_backoff_factor up to the maximum
     "streaming_update_interval": 0.5,
+    "streaming_backoff_factor": 1.5,
+    "streaming_max_update_interval": 3,
+    # Outbound edit budget shared by all chats, and retries for edits hit by a 429
+    "telegram_global_edits_per_second": 25,
+    "telegram_max_retries": 3,
+    # Streamed answers continue in a new message once a page's MarkdownV2 would exceed
+    # this many characters (Telegram's hard limit is 4096)
+    "streaming_page_limit": 4000,
     "api_check_concurrency": 10,
+    # Client-side request budgets per key, per model (requests / tokens per minute).
+    # Keys /api_check classifies as paid use the "paid" tier, standard keys "free";
+    # keys not checked yet use rate_limit_default_tier.
+    "rate_limits": {
+        "free": {
+            "model_1": {"rpm": 5, "tpm": 250000},
+            "model_2": {"rpm": 10, "tpm": 250000},
+            "model_3": {"rpm": 10, "tpm": 200000},
+        },
+        "paid": {
+            "model_1": {"rpm": 150, "tpm": 2000000},
+            "model_2": {"rpm": 1000, "tpm": 1000000},
+            "model_3": {"rpm": 500, "tpm": 500000},
+        },
+    },
+    # Tier of keys /api_check has not classified yet ("free" or "paid"). With None, client-side
+    # limiting is off for a key until /api_check has run for it (a warning at startup lists them)
+    "rate_limit_default_tier": None,
+    # File keeping the tiers found by /api_check across restarts (by key hash)
+    "key_tiers_path": "key_tiers.json",
+    # Longest time a request waits for a key to get budget before giving up
+    "rate_limit_max_wait": 5,
+    "http_max_connections": 100,
+    "http_keepalive_timeout": 60,
+    "user_registry_check_interval": 5,
+    # Chat sessions kept in memory: least recently used ones are evicted past these
+    # limits, and sessions idle for longer than the TTL (seconds) are dropped
+    "session_max_count": 1000,
+    "session_max_history_bytes": 256 * 1024 * 1024,
+    "session_idle_ttl": 24 * 60 * 60,
+    # SQLite file keeping chat histories across restarts (empty to keep them in memory only)
+    "history_db_path": "chat_history.db",
+    # Token budget of a chat's history per model; once a turn would exceed it, the
+    # oldest turns are dropped down to context_trim_target of the budget
+    "context_token_budgets": {
+        "model_1": 200000,
+        "model_2": 200000,
+        "paid_model_for_check": 200000,
+    },
+    "context_trim_target": 0.75,
+    # Optional compaction of /switch chats: past the threshold (tokens), model_2 summarizes
+    # all but the last few turns in the background, and the summary replaces them
+    "history_summarization": False,
+    "history_summary_threshold": 32000,
+    "history_summary_keep_turns": 4,
+    # Pool decoding and re-encoding photos with Pillow: "thread" or "process", and its size
+    "image_pool_type": "thread",
+    "image_pool_size": 2,
+    # Largest useful longer side (pixels) of a photo: the Telegram size to download is picked
+    # from it, larger photos are scaled down (JPEGs to between half of it and it), and
+    # JPEGs within it are sent unchanged
+    "image_max_side": 1536,
+    # Answers of image understanding reused for the same photo, prompt, model and system prompt
+    "image_answer_cache_size": 256,
+    "image_answer_cache_ttl": 24 * 60 * 60,
+    # /draw results reused for the same prompt, by the file_id of the first upload
+    "draw_cache_size": 512,
+    "draw_cache_ttl": 7 * 24 * 60 * 60,
+    # Webhook mode: updates processed at the same time, and connections Telegram may open
+    "webhook_max_concurrent_updates": 64,
+    "webhook_max_connections": 40,
+    # Worker processes (main.py --workers) and the SQLite file they share keys and cooldowns
+    # through, checked for changes of other workers at most every sync interval (seconds)
+    "workers": 1,
+    "shared_state_path": "bot_state.db",
+    "shared_state_sync_interval": 1,
+    # File remembering the command menu last set per user; at startup only changed menus
+    # are set, at most menu_registration_concurrency at a time, and with
+    # menu_registration_background the bot serves updates meanwhile
+    "menu_state_file": "menu_state.json",
+    "menu_registration_concurrency": 8,
+    "menu_registration_background": False,
+    # Budget for the import time of startup checked by `main.py --check-startup`
+    # (milliseconds; exceeding it exits nonzero, e.g. to fail a CI or image build)
+    "startup_import_budget_ms": 2500,
+    # Port serving Prometheus metrics at /metrics (0 disables it); with several
+    # workers, worker i serves its own metrics on metrics_port + i
+    "metrics_port": 0,
+    # Generations running at the same time, and how many more may wait before users get a "busy" reply
+    "max_concurrent_generations": 32,
+    "max_waiting_generations": 64,
+    # Generations one user may have waiting (behind their own or for a slot) before they get a reply to wait
+    "max_queued_per_user": 2,
+    # Private text messages of a user arriving within this many milliseconds of each other
+    # (e.g. a long paste split by Telegram) are answered as one prompt; 0 disables this
+    "message_coalesce_window_ms": 0,
+    # Photos of an album (media group) arriving within this many milliseconds of each other
+    # are sent to the model in one request with one answer; 0 answers each photo separately
+    "media_group_window_ms": 800,
     "model_1": "gemini-2.5-pro",
     "model_2": "gemini-2.5-flash",
     "model_3": "gemini-2.5-flash-image-preview",
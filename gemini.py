@@ -1,7 +1,6 @@
 import io
 import time
 import sys
-from PIL import Image
 from telebot.types import Message
 from md2tgmd import escape
 from telebot import TeleBot
@@ -13,7 +12,18 @@ from google.genai.types import Tool, UrlContext, GoogleSearch
 
 import re
 import asyncio
+import inspect
 import logging
+import aiohttp
+import weakref
+import hashlib
+from streaming import StreamRenderer, EditScheduler, is_parse_error
+from rate_limiter import RateLimiter, estimate_tokens, IMAGE_TOKENS
+from sessions import SessionStore
+from history_store import HistoryStore
+from images import prepare_image
+from result_cache import ResultCache
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -27,10 +37,27 @@ current_api_key_index = 0
 # Cooldown tracking for rate-limited keys
 api_key_cooldowns = {}
 
-gemini_draw_dict = {}
-gemini_chat_dict = {}
-gemini_pro_chat_dict = {}
-switchable_chat_sessions = {}
+# Key list, cooldowns and key tiers shared with the other worker processes (state_store.SharedState), if any
+shared_state = None
+_shared_state_synced_at = 0.0
+
+# Client-side RPM/TPM budgets per key and model, consulted before sending
+rate_limiter = RateLimiter(conf)
+
+# Paces streaming message edits across all chats
+edit_scheduler = EditScheduler(conf)
+
+# Chat sessions of all users, bounded by count, history size and idle time
+# The on-disk copy of the histories is opened at startup (open_history_store), not on import
+session_store = SessionStore(conf)
+gemini_draw_dict = session_store.namespace("draw")
+gemini_chat_dict = session_store.namespace("gemini")
+gemini_pro_chat_dict = session_store.namespace("gemini_pro")
+switchable_chat_sessions = session_store.namespace("switchable")
+metrics.active_sessions.set_function(lambda: {
+    (namespace.name,): len(namespace)
+    for namespace in (gemini_draw_dict, gemini_chat_dict, gemini_pro_chat_dict, switchable_chat_sessions)
+})
 user_language_dict = {}
 user_system_prompt_dict = {}
 user_model_index_dict = {}
@@ -48,17 +75,95 @@ download_pic_notify     =       conf["download_pic_notify"]
 
 client = None
 
+# Long-lived clients, one per API key, all sharing one aiohttp connection pool
+client_pool = {}
+_shared_http_session = None
+
+def _build_http_options():
+    global _shared_http_session
+    if "aiohttp_client" not in types.HttpOptions.model_fields:
+        return None
+    if _shared_http_session is None or _shared_http_session.closed:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # The session must be bound to the running loop; fall back to a per-client pool
+            return None
+        connector = aiohttp.TCPConnector(
+            limit=conf.get("http_max_connections", 100),
+            keepalive_timeout=conf.get("http_keepalive_timeout", 60),
+        )
+        _shared_http_session = aiohttp.ClientSession(connector=connector, trust_env=True)
+    return types.HttpOptions(aiohttp_client=_shared_http_session)
+
+def _create_client(key):
+    http_options = _build_http_options()
+    if http_options is None:
+        return genai.Client(api_key=key)
+    return genai.Client(api_key=key, http_options=http_options)
+
+def get_pooled_client(key):
+    """Returns the long-lived client for a key, creating it on first use."""
+    pooled_client = client_pool.get(key)
+    if pooled_client is None:
+        pooled_client = _create_client(key)
+        client_pool[key] = pooled_client
+    return pooled_client
+
+async def _close_client(old_client):
+    try:
+        await old_client.aio.aclose()
+    except Exception as e:
+        logger.warning(f"Error closing Gemini client: {e}")
+
+def release_pooled_client(key):
+    """Drops the pooled client of a removed key and closes it in the background."""
+    pooled_client = client_pool.pop(key, None)
+    if pooled_client is None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    loop.create_task(_close_client(pooled_client))
+
+async def close_client_pool():
+    global _shared_http_session
+    for key in list(client_pool):
+        await _close_client(client_pool.pop(key))
+    if _shared_http_session is not None and not _shared_http_session.closed:
+        await _shared_http_session.close()
+    _shared_http_session = None
+
 async def initialize_client():
     global client
     if api_keys:
         try:
-            client = genai.Client(api_key=api_keys[current_api_key_index])
+            client = get_pooled_client(api_keys[current_api_key_index])
             logger.info("Gemini client initialized successfully.")
         except Exception as e:
             logger.error(f"Error initializing client: {e}")
+        unclassified = sum(1 for key in api_keys if rate_limiter.get_key_tier(key) is None)
+        if unclassified:
+            logger.warning(f"{unclassified} API keys have no known tier and are not rate limited until /api_check classifies them.")
     else:
         logger.warning("No API keys found. Client remains uninitialized.")
 
+def get_cooldown_from_exc(e):
+    if hasattr(e, "response") and hasattr(e.response, "headers"):
+        retry_after = e.response.headers.get("retry-after")
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+    if hasattr(e, "__cause__") and hasattr(e.__cause__, "trailing_metadata"):
+        for k, v in e.__cause__.trailing_metadata():
+            if k == 'retry-after' and v.isdigit():
+                return int(v)
+    if "429" in str(e):
+        match = re.search(r"retry-after: (\d+)", str(e), re.IGNORECASE)
+        if match:
+            return int(match.group(1))
+    return 60
+
 async def check_individual_keys(keys_to_check, paid_model_name, standard_model_name):
     """
     Checks a given list of API keys and returns them classified.
@@ -73,41 +178,30 @@ async def check_individual_keys(keys_to_check, paid_model_name, standard_model_n
         if key in api_key_cooldowns:
             del api_key_cooldowns[key]
         async with semaphore:
-            temp_client = genai.Client(api_key=key)
-            def get_cooldown_from_exc(e):
-                if hasattr(e, "response") and hasattr(e.response, "headers"):
-                    retry_after = e.response.headers.get("retry-after")
-                    if retry_after and retry_after.isdigit():
-                        return int(retry_after)
-                if hasattr(e, "__cause__") and hasattr(e.__cause__, "trailing_metadata"):
-                    for k, v in e.__cause__.trailing_metadata():
-                        if k == 'retry-after' and v.isdigit():
-                            return int(v)
-                if "429" in str(e):
-                    match = re.search(r"retry-after: (\d+)", str(e), re.IGNORECASE)
-                    if match:
-                        return int(match.group(1))
-                return 60
+            # Stored keys reuse their pooled client; ad-hoc keys still share the connection pool
+            temp_client = get_pooled_client(key) if key in api_keys else _create_client(key)
             try:
                 if paid_model_name:
                     await temp_client.aio.models.generate_content(model=paid_model_name, contents="hi")
                 logger.info(f"Key {index} ({key[:5]}...) is PAID.")
+                set_key_tier(key, "paid")
                 return "paid", (index, key)
             except Exception:
                 pass
             try:
                 await temp_client.aio.models.generate_content(model=standard_model_name, contents="hi")
                 logger.info(f"Key {index} ({key[:5]}...) is STANDARD.")
+                set_key_tier(key, "free")
                 return "standard", (index, key)
             except (google_api_exceptions.ResourceExhausted, google_api_exceptions.TooManyRequests) as e:
                 cooldown = get_cooldown_from_exc(e)
-                api_key_cooldowns[key] = time.time() + cooldown
+                set_api_key_cooldown(key, cooldown)
                 logger.warning(f"Key {index} ({key[:5]}...) is RATE LIMITED. Cooldown set for {cooldown}s.")
                 return "rate_limited", (index, key)
             except Exception as e:
                 if "429" in str(e):
                     cooldown = get_cooldown_from_exc(e)
-                    api_key_cooldowns[key] = time.time() + cooldown
+                    set_api_key_cooldown(key, cooldown)
                     logger.warning(f"Key {index} ({key[:5]}...) is RATE LIMITED (429). Cooldown set for {cooldown}s.")
                     return "rate_limited", (index, key)
                 logger.error(f"Key {index} ({key[:5]}...) is INVALID. Reason: {type(e).__name__}")
@@ -115,6 +209,7 @@ async def check_individual_keys(keys_to_check, paid_model_name, standard_model_n
 
     tasks = [check_key(i, key) for i, key in enumerate(keys_to_check)]
     results = await asyncio.gather(*tasks)
+    await rate_limiter.save_tiers()
 
     paid_keys = [item for status, item in results if status == 'paid']
     standard_keys = [item for status, item in results if status == 'standard']
@@ -157,7 +252,8 @@ def switch_to_next_api_key():
             continue
 
         try:
-            client = genai.Client(api_key=key_to_check)
+            client = get_pooled_client(key_to_check)
+            metrics.key_switches.inc()
             logger.info(f"Successfully switched to API key #{current_api_key_index}")
             return True
         except Exception as e:
@@ -166,6 +262,370 @@ def switch_to_next_api_key():
             
     return False
 
+def open_history_store():
+    """Keeps chat histories in conf["history_db_path"] from now on, if set."""
+    if conf.get("history_db_path") and session_store.history_store is None:
+        session_store.history_store = HistoryStore(conf["history_db_path"])
+
+# --- Shared State ---
+
+def set_api_key_cooldown(key, cooldown):
+    metrics.rate_limited.inc(key=metrics.key_label(key))
+    until = time.time() + cooldown
+    api_key_cooldowns[key] = until
+    if shared_state is not None:
+        try:
+            shared_state.set_cooldown(key, until)
+        except Exception as e:
+            logger.error(f"Failed to share cooldown of key {key[:5]}...: {e}")
+
+def set_key_tier(key, tier):
+    """Records the tier /api_check found for a key, for this and the other workers."""
+    rate_limiter.set_key_tier(key, tier)
+    if shared_state is not None:
+        try:
+            shared_state.set_key_tier(key, tier)
+        except Exception as e:
+            logger.error(f"Failed to share tier of key {key[:5]}...: {e}")
+
+def publish_api_keys():
+    """Writes the key list to the shared state after a local change."""
+    if shared_state is not None:
+        try:
+            shared_state.set_api_keys(api_keys)
+        except Exception as e:
+            logger.error(f"Failed to share API keys: {e}")
+
+def apply_api_keys(keys):
+    """Replaces the key list with `keys`, keeping the current key if it is still there."""
+    global current_api_key_index, client
+    if keys == api_keys:
+        return
+    current_key = get_current_api_key()
+    for key in set(api_keys) - set(keys):
+        release_pooled_client(key)
+        rate_limiter.forget_key(key)
+    api_keys[:] = keys
+    current_api_key_index = api_keys.index(current_key) if current_key in api_keys else 0
+    client = get_pooled_client(api_keys[current_api_key_index]) if api_keys else None
+    logger.info(f"API keys updated from shared state, {len(api_keys)} keys.")
+
+async def sync_shared_state(force=False):
+    """Picks up key changes and cooldowns of the other workers, at most every conf["shared_state_sync_interval"] seconds."""
+    global _shared_state_synced_at
+    if shared_state is None:
+        return
+    now = time.monotonic()
+    if not force and now - _shared_state_synced_at < conf.get("shared_state_sync_interval", 1):
+        return
+    _shared_state_synced_at = now
+    try:
+        keys, cooldowns, tiers = await asyncio.to_thread(shared_state.load)
+    except Exception as e:
+        logger.error(f"Failed to read shared state: {e}")
+        return
+    apply_api_keys(keys)
+    for key, until in cooldowns.items():
+        if until > api_key_cooldowns.get(key, 0):
+            api_key_cooldowns[key] = until
+    # The worker that ran /api_check has saved the tiers already
+    for key, tier in tiers.items():
+        rate_limiter.set_key_tier(key, tier, save=False)
+
+# --- Key Leasing ---
+# Every request leases a key for its duration. Keys are picked by fewest
+# in-flight requests (ties broken round-robin), skipping keys in cooldown,
+# so concurrent users are spread across all healthy keys.
+
+api_key_in_flight = {}
+_lease_cursor = 0
+
+# Chat sessions are bound to the key they were created with
+chat_api_keys = weakref.WeakKeyDictionary()
+# Context size (tokens) of each chat after its last turn, from usage_metadata
+chat_context_tokens = weakref.WeakKeyDictionary()
+# Answers of image understanding by (photo, prompt, model, system prompt), as pages of (MarkdownV2, plain text)
+image_answer_cache = ResultCache("image_answer", conf.get("image_answer_cache_size", 256), conf.get("image_answer_cache_ttl"))
+
+# Generated images by (prompt, model, config), as (Telegram file_id of the photo, text)
+draw_cache = ResultCache("draw", conf.get("draw_cache_size", 512), conf.get("draw_cache_ttl"))
+metrics.cache_entries.set_function(lambda: {(cache.name,): len(cache) for cache in (image_answer_cache, draw_cache)})
+
+# Summaries of old turns being written in the background, per user: (summarized turns, task)
+pending_summaries = {}
+
+def is_api_key_in_cooldown(key, now=None):
+    until = api_key_cooldowns.get(key)
+    return until is not None and (now or time.time()) < until
+
+def acquire_api_key(preferred_key=None, exclude=(), model_name=None, tokens=0):
+    """Leases a key, keeping `preferred_key` if it is still healthy. Returns None if none is available now."""
+    global _lease_cursor
+    now = time.time()
+
+    def is_available(k):
+        return (k not in exclude and not is_api_key_in_cooldown(k, now)
+                and rate_limiter.wait_time(k, model_name, tokens) == 0)
+
+    if preferred_key in api_keys and is_available(preferred_key):
+        key = preferred_key
+    else:
+        healthy = [k for k in api_keys if is_available(k)]
+        if not healthy:
+            return None
+        start = _lease_cursor % len(healthy)
+        _lease_cursor += 1
+        rotated = healthy[start:] + healthy[:start]
+        key = min(rotated, key=lambda k: api_key_in_flight.get(k, 0))
+    rate_limiter.consume(key, model_name, tokens)
+    api_key_in_flight[key] = api_key_in_flight.get(key, 0) + 1
+    return key
+
+async def lease_api_key(preferred_key=None, exclude=(), model_name=None, tokens=0):
+    """
+    Like acquire_api_key, but when every healthy key is over its client-side budget,
+    waits up to conf["rate_limit_max_wait"] seconds for one to free up.
+    """
+    await sync_shared_state()
+    deadline = time.monotonic() + conf.get("rate_limit_max_wait", 5)
+    while True:
+        key = acquire_api_key(preferred_key, exclude, model_name, tokens)
+        if key is not None:
+            return key
+        now = time.time()
+        waits = [rate_limiter.wait_time(k, model_name, tokens) for k in api_keys
+                 if k not in exclude and not is_api_key_in_cooldown(k, now)]
+        if not waits:
+            return None
+        wait = min(waits)
+        if time.monotonic() + wait > deadline:
+            logger.warning(f"All keys are over their budget for {model_name}, shortest wait {wait:.1f}s.")
+            return None
+        await asyncio.sleep(wait)
+
+def release_api_key(key):
+    remaining = api_key_in_flight.get(key, 0) - 1
+    if remaining > 0:
+        api_key_in_flight[key] = remaining
+    else:
+        api_key_in_flight.pop(key, None)
+
+async def failover_api_key(failed_key, tried_keys, cooldown=None, model_name=None, tokens=0):
+    """Releases a failed lease and leases a key that has not been tried yet for this request."""
+    metrics.key_failovers.inc(model=model_name)
+    async with api_key_lock:
+        release_api_key(failed_key)
+        tried_keys.add(failed_key)
+        if cooldown:
+            set_api_key_cooldown(failed_key, cooldown)
+            logger.warning(f"Key {failed_key[:5]}... put in cooldown for {cooldown}s.")
+        if failed_key == get_current_api_key():
+            # Move the default key away from the failing one as well
+            switch_to_next_api_key()
+    return await lease_api_key(exclude=tried_keys, model_name=model_name, tokens=tokens)
+
+def estimate_history_tokens(history):
+    total = 0
+    for content in history:
+        for part in content.parts or []:
+            if getattr(part, 'text', None):
+                total += estimate_tokens(part.text)
+            elif getattr(part, 'inline_data', None):
+                total += IMAGE_TOKENS
+    return total
+
+def get_context_budget(model_name):
+    """The history token budget configured for a model, or None."""
+    for model_key, budget in conf.get("context_token_budgets", {}).items():
+        if conf.get(model_key) == model_name:
+            return budget
+    return None
+
+def record_context_tokens(chat, usage):
+    """Remembers the context size of a chat after a turn, as counted by the API."""
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    if prompt_tokens is not None:
+        chat_context_tokens[chat] = prompt_tokens + (getattr(usage, 'candidates_token_count', None) or 0)
+
+def fit_history_to_budget(chat, history, model_name, user_id, prompt_tokens):
+    """
+    Drops the oldest turns of `history` once it and the next prompt exceed the
+    model's budget, down to conf["context_trim_target"] of it.
+    The system instruction is not part of the history and is always kept.
+    Returns the history and whether it was trimmed.
+    """
+    budget = get_context_budget(model_name)
+    if not budget or not history:
+        return history, False
+    turn_tokens = [estimate_history_tokens([content]) for content in history]
+    estimated = sum(turn_tokens) + estimate_tokens(get_system_prompt(user_id))
+    # Prefer the size reported by the API for the last turn, and scale the estimates to it
+    counted = chat_context_tokens.get(chat) if chat is not None else None
+    scale = counted / estimated if counted and estimated else 1.0
+    total = (counted or estimated) + prompt_tokens
+    if total <= budget:
+        return history, False
+    target = budget * conf.get("context_trim_target", 0.75)
+    start = 0
+    while start < len(history) and total > target:
+        total -= turn_tokens[start] * scale
+        start += 1
+        # Never start the history in the middle of a turn
+        while start < len(history) and history[start].role != "user":
+            total -= turn_tokens[start] * scale
+            start += 1
+    logger.info(f"History of user {user_id} over the {budget} token budget of {model_name}, dropped {start} of {len(history)} messages.")
+    return history[start:], True
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for your own future reference. Keep the facts, "
+    "decisions, names, numbers, code and preferences the user stated, and any open "
+    "questions. Write it in the language of the conversation, as concise notes.\n\n"
+)
+
+def get_turn_start(history, keep_turns):
+    """Index of the first message of the last `keep_turns` turns of `history`."""
+    start = len(history)
+    for _ in range(keep_turns):
+        start -= 1
+        while start > 0 and history[start].role != "user":
+            start -= 1
+        if start <= 0:
+            return 0
+    return start
+
+def format_transcript(history):
+    lines = []
+    for content in history:
+        texts = []
+        for part in content.parts or []:
+            if getattr(part, 'text', None):
+                texts.append(part.text)
+            elif getattr(part, 'inline_data', None):
+                texts.append("[image]")
+        if texts:
+            lines.append(f"{content.role}: {' '.join(texts)}")
+    return "\n\n".join(lines)
+
+async def summarize_history(history):
+    """Asks model_2 for a summary of `history`; returns it as a user/model turn pair, or None."""
+    transcript = format_transcript(history)
+    estimated_tokens = estimate_tokens(transcript)
+    api_key = await lease_api_key(model_name=model_2, tokens=estimated_tokens)
+    if api_key is None:
+        logger.warning("No API key available for history summarization.")
+        return None
+    try:
+        response = await get_pooled_client(api_key).aio.models.generate_content(
+            model=model_2,
+            contents=SUMMARY_PROMPT + transcript,
+        )
+        if getattr(response, 'usage_metadata', None):
+            rate_limiter.record_usage(api_key, model_2, response.usage_metadata.total_token_count, estimated_tokens)
+        summary = response.text
+    except Exception as e:
+        logger.error(f"History summarization failed: {e}")
+        return None
+    finally:
+        release_api_key(api_key)
+    if not summary or not summary.strip():
+        return None
+    return [
+        types.Content(role="user", parts=[types.Part.from_text(text=f"Summary of our earlier conversation:\n{summary.strip()}")]),
+        types.Content(role="model", parts=[types.Part.from_text(text="Noted, I will keep this context in mind.")]),
+    ]
+
+def schedule_history_summary(user_id, chat):
+    """
+    Starts summarizing the older turns of a switchable chat in the background once its
+    history passes conf["history_summary_threshold"] tokens. The summary replaces those
+    turns on the user's next message, see apply_history_summary().
+    """
+    user_id_str = str(user_id)
+    if not conf.get("history_summarization") or user_id_str in pending_summaries:
+        return
+    history = get_chat_history(chat)
+    tokens = chat_context_tokens.get(chat) or estimate_history_tokens(history)
+    if tokens < conf.get("history_summary_threshold", 32000):
+        return
+    cut = get_turn_start(history, conf.get("history_summary_keep_turns", 4))
+    # Summarizing a single turn would not save anything
+    if cut < 4:
+        return
+    old_turns = list(history[:cut])
+    logger.info(f"Summarizing {cut} of {len(history)} messages of user {user_id_str} in the background.")
+    pending_summaries[user_id_str] = (old_turns, asyncio.ensure_future(summarize_history(old_turns)))
+
+def discard_history_summary(namespace, user_id):
+    """Drops the pending summary of a switchable chat that was cleared or evicted."""
+    if namespace != switchable_chat_sessions.name:
+        return
+    pending = pending_summaries.pop(str(user_id), None)
+    if pending is not None:
+        pending[1].cancel()
+
+session_store.on_drop = discard_history_summary
+
+def apply_history_summary(user_id, history):
+    """
+    Swaps a finished summary in for the turns it covers, if the history still starts
+    with them. Returns the history and whether it changed.
+    """
+    user_id_str = str(user_id)
+    pending = pending_summaries.get(user_id_str)
+    if pending is None or not pending[1].done():
+        return history, False
+    del pending_summaries[user_id_str]
+    old_turns, task = pending
+    summary = None if task.cancelled() or task.exception() else task.result()
+    if summary is None or len(history) < len(old_turns):
+        return history, False
+    if any(a is not b and a != b for a, b in zip(old_turns, history)):
+        # The history was cleared, trimmed or replaced meanwhile
+        return history, False
+    logger.info(f"Replaced {len(old_turns)} messages of user {user_id_str} with their summary.")
+    return summary + list(history[len(old_turns):]), True
+
+def get_chat_history(chat):
+    if chat is None:
+        return []
+    if hasattr(chat, 'get_history'):
+        return list(chat.get_history(curated=True))
+    return list(getattr(chat, 'history', []))
+
+def create_chat(api_key, model_name, user_id, history=None):
+    """Creates a chat session on the given key with the user's system prompt."""
+    chat_client = get_pooled_client(api_key)
+    try:
+        # Create a copy of the base config and add the system prompt
+        config_copy = generation_config.copy()
+        config_copy['system_instruction'] = get_system_prompt(user_id)
+        chat = chat_client.aio.chats.create(
+            model=model_name,
+            history=history or [],
+            config=types.GenerateContentConfig(**config_copy)
+        )
+    except Exception as e:
+        logger.error(f"Failed to set system prompt: {e}")
+        chat = chat_client.aio.chats.create(
+            model=model_name,
+            history=history or [],
+            config=types.GenerateContentConfig(**generation_config)
+        )
+    chat_api_keys[chat] = api_key
+    return chat
+
+def bind_chat_to_key(chat, api_key, model_name, user_id, history=None):
+    """
+    Returns a chat usable with `api_key`, moving the history over if it was bound to another key.
+    `history` is used when there is no chat in memory (e.g. a history restored from disk).
+    """
+    if chat is not None and chat_api_keys.get(chat) == api_key:
+        return chat
+    if chat is not None or history is None:
+        history = get_chat_history(chat)
+    return create_chat(api_key, model_name, user_id, history=history)
+
 def get_current_chat_model_key(user_id):
     """Gets the key for the user's current chat model (e.g., 'model_1')."""
     user_id_str = str(user_id)
@@ -196,12 +656,12 @@ def add_api_key(key):
         api_keys.append(key)
         if len(api_keys) == 1:
             try:
-                client = genai.Client(api_key=key)
-                return True
+                client = get_pooled_client(key)
             except Exception as e:
                 logger.error(f"Error initializing client with new API key: {e}")
                 api_keys.pop()
                 return False
+        publish_api_keys()
         return True
     return False
 
@@ -213,6 +673,9 @@ def remove_api_key(key):
         was_current_key = (key == active_key_value)
         
         api_keys.remove(key)
+        release_pooled_client(key)
+        rate_limiter.forget_key(key)
+        publish_api_keys()
         
         if not api_keys:
             current_api_key_index = 0
@@ -234,7 +697,7 @@ def remove_api_key(key):
         
         # Always re-initialize the client to ensure state consistency
         try:
-            client = genai.Client(api_key=api_keys[current_api_key_index])
+            client = get_pooled_client(api_keys[current_api_key_index])
             logger.info(f"Key removed. New active key is at index {current_api_key_index}.")
         except Exception as e:
             logger.error(f"Failed to re-initialize client after removing key: {e}")
@@ -255,16 +718,20 @@ def list_api_keys():
 
 def remove_all_api_keys():
     global api_keys, current_api_key_index, client
+    for key in api_keys:
+        release_pooled_client(key)
+        rate_limiter.forget_key(key)
     api_keys.clear()
     current_api_key_index = 0
     client = None
+    publish_api_keys()
     return True
 
 def set_current_api_key(index):
     global current_api_key_index, client
     if 0 <= index < len(api_keys):
         try:
-            test_client = genai.Client(api_key=api_keys[index])
+            test_client = get_pooled_client(api_keys[index])
             current_api_key_index = index
             client = test_client
             return True
@@ -300,26 +767,20 @@ def get_system_prompt(user_id):
 async def set_system_prompt(bot: TeleBot, message: Message, prompt: str):
     user_id_str = str(message.from_user.id)
     user_system_prompt_dict[user_id_str] = prompt
-    if user_id_str in gemini_chat_dict: del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict: del gemini_pro_chat_dict[user_id_str]
-    if user_id_str in switchable_chat_sessions: del switchable_chat_sessions[user_id_str]
+    await session_store.clear_user(user_id_str)
     confirmation_msg = f"{get_user_text(message.from_user.id, 'system_prompt_set')}\n{prompt}"
     await bot.reply_to(message, confirmation_msg)
 
 async def delete_system_prompt(bot: TeleBot, message: Message):
     user_id_str = str(message.from_user.id)
     if user_id_str in user_system_prompt_dict: del user_system_prompt_dict[user_id_str]
-    if user_id_str in gemini_chat_dict: del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict: del gemini_pro_chat_dict[user_id_str]
-    if user_id_str in switchable_chat_sessions: del switchable_chat_sessions[user_id_str]
+    await session_store.clear_user(user_id_str)
     await bot.reply_to(message, get_user_text(message.from_user.id, 'system_prompt_deleted'))
 
 async def reset_system_prompt(bot: TeleBot, message: Message):
     user_id_str = str(message.from_user.id)
     user_system_prompt_dict[user_id_str] = DEFAULT_SYSTEM_PROMPT
-    if user_id_str in gemini_chat_dict: del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict: del gemini_pro_chat_dict[user_id_str]
-    if user_id_str in switchable_chat_sessions: del switchable_chat_sessions[user_id_str]
+    await session_store.clear_user(user_id_str)
     await bot.reply_to(message, get_user_text(message.from_user.id, 'system_prompt_reset'))
 
 async def show_system_prompt(bot: TeleBot, message: Message):
@@ -327,99 +788,147 @@ async def show_system_prompt(bot: TeleBot, message: Message):
     prompt = get_system_prompt(user_id)
     await bot.reply_to(message, f"{get_user_text(user_id, 'system_prompt_current')}\n{prompt}")
 
+def record_first_token(model_name, started):
+    elapsed = time.monotonic() - started
+    logger.info(f"Time to first token for {model_name}: {elapsed:.2f}s")
+    metrics.time_to_first_token.observe(elapsed, model=model_name)
+
+def record_generation(model_name, started, chunk_count):
+    """Records a finished stream of `chunk_count` chunks started at `started` (time.monotonic())."""
+    metrics.generation_seconds.observe(time.monotonic() - started, model=model_name)
+    metrics.response_chunks.observe(chunk_count, model=model_name)
+
 async def safe_edit_message(bot, text, chat_id, message_id, parse_mode=None):
     try:
-        kwargs = {"text": text, "chat_id": chat_id, "message_id": message_id}
-        if parse_mode:
-            kwargs["parse_mode"] = parse_mode
-        await bot.edit_message_text(**kwargs)
+        # Goes through the edit scheduler so it replaces any queued stream update
+        # and respects Telegram flood limits
+        await edit_scheduler.edit_now(bot, text, chat_id, message_id, parse_mode)
     except Exception as e:
         # We only want to log errors that are not "message is not modified"
         if "message is not modified" not in str(e).lower():
             # Re-raise the exception to be handled by the calling function
             raise e
 
+async def roll_over_pages(bot, message, sent_message, renderer):
+    """
+    Freezes pages of a streamed answer that no longer fit in one Telegram message
+    and continues in a new message. Returns the message holding the current page.
+    Telegram errors are logged here rather than raised, so they are never mistaken
+    for a failure of the model request.
+    """
+    for page in renderer.update_pages():
+        try:
+            try:
+                await safe_edit_message(bot, escape(page), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
+            except Exception as e:
+                if not is_parse_error(e):
+                    raise
+                await safe_edit_message(bot, page, sent_message.chat.id, sent_message.message_id)
+        except Exception as e:
+            logger.warning(f"Error freezing page of streamed answer: {e}")
+        try:
+            sent_message = await edit_scheduler.send_now(
+                bot,
+                sent_message.chat.id,
+                get_user_text(message.from_user.id, "continued_answer"),
+                reply_to_message_id=sent_message.message_id
+            )
+        except Exception as e:
+            # Keep streaming into the current message; the frozen page is overwritten
+            logger.error(f"Failed to send continuation of streamed answer: {e}")
+    return sent_message
 
 async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
     sent_message = None
+    api_key = None
+    placeholder_task = None
     try:
         # Lock before checking for client to prevent race conditions
         async with api_key_lock:
             if client is None:
                 await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty") )
                 return
-            
-        sent_message = await bot.reply_to(message, get_user_text(message.from_user.id, "generating_answer"))
+ 
+        # Send the placeholder while the model request is being set up and sent
+        request_started = time.monotonic()
+        placeholder_task = asyncio.ensure_future(bot.reply_to(message, get_user_text(message.from_user.id, "generating_answer")))
 
         chat_dict = gemini_chat_dict if model_type == model_1 else gemini_pro_chat_dict
         user_id_str = str(message.from_user.id)
 
-        # Initialize chat outside the retry loop but after the client check
-        if user_id_str not in chat_dict:
-            system_prompt = get_system_prompt(message.from_user.id)
-            try:
-                # Create a copy of the base config and add the system prompt
-                config_copy = generation_config.copy()
-                config_copy['system_instruction'] = system_prompt
-                
-                chat = client.aio.chats.create(
-                    model=model_type,
-                    config=types.GenerateContentConfig(**config_copy)
-                )
-                chat_dict[user_id_str] = chat
-            except Exception as e:
-                logger.error(f"Failed to set system prompt: {e}")
-                chat = client.aio.chats.create(
-                    model=model_type,
-                    config=types.GenerateContentConfig(**generation_config)
-                )
-                chat_dict[user_id_str] = chat
-        else:
-            chat = chat_dict[user_id_str]
+        # Lease a key, preferring the one the user's chat is bound to
+        chat, history = await chat_dict.restore(user_id_str)
+        history, trimmed = fit_history_to_budget(chat, history, model_type, message.from_user.id, estimate_tokens(m))
+        if trimmed:
+            chat = None
+        estimated_tokens = estimate_tokens(m) + estimate_history_tokens(history)
+        api_key = await lease_api_key(chat_api_keys.get(chat) if chat is not None else None, model_name=model_type, tokens=estimated_tokens)
+        if api_key is None:
+            sent_message = await placeholder_task
+            await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
+            return
+        chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id, history=history)
+        chat_dict[user_id_str] = chat
+        if trimmed:
+            await chat_dict.persist(user_id_str, chat, rewrite=True)
             
         lang = get_user_lang(message.from_user.id)
         if lang == "zh" and "用中文回复" not in m: m += "，请用中文回复"
 
         retry_count = 0
+        tried_keys = set()
         # Use a copy of api_keys length for stable loop bound
         max_retries = len(api_keys)
         while retry_count < max_retries:
             try:
-                response = await chat.send_message_stream(m)
-                full_response = ""
-                last_update = time.time()
-                update_interval = conf["streaming_update_interval"]
-
+                response_task = asyncio.ensure_future(chat.send_message_stream(m))
+                if sent_message is None:
+                    try:
+                        sent_message = await placeholder_task
+                    except BaseException:
+                        response_task.cancel()
+                        raise
+                response = await response_task
+                renderer = StreamRenderer(page_limit=conf["streaming_page_limit"])
+
+                usage = None
+                chunk_count = 0
                 async for chunk in response:
+                    chunk_count += 1
+                    if chunk_count == 1:
+                        record_first_token(model_type, request_started)
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage = chunk.usage_metadata
                     for part in chunk.candidates[0].content.parts:
                         if part.text:
-                            full_response += part.text
+                            renderer.append(part.text)
                         if hasattr(part, 'executable_code') and part.executable_code:
                             code_to_display = f"\n\n> **Executing Code:**\n```python\n{part.executable_code.code}\n```"
-                            full_response += code_to_display
+                            renderer.append(code_to_display)
                         if hasattr(part, 'code_execution_result') and part.code_execution_result:
                             result_to_display = f"\n\n> **Result:**\n{part.code_execution_result.output}\n"
-                            full_response += result_to_display
+                            renderer.append(result_to_display)
                     
-                    if time.time() - last_update >= update_interval:
-                        try:
-                            await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                        except Exception as e:
-                            if "parse" in str(e).lower() or "entity" in str(e).lower():
-                                await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                            else:
-                                logger.warning(f"Error updating message during stream: {e}")
-                        last_update = time.time()
+                    sent_message = await roll_over_pages(bot, message, sent_message, renderer)
+                    edit_scheduler.submit(bot, sent_message.chat.id, sent_message.message_id, renderer.render, lambda: renderer.text)
+                record_generation(model_type, request_started, chunk_count)
+
+                if usage:
+                    rate_limiter.record_usage(api_key, model_type, usage.total_token_count, estimated_tokens)
+                    record_context_tokens(chat, usage)
+
+                # Record the turn for the session limits and on disk
+                await chat_dict.persist(user_id_str, chat)
 
                 # Final message processing
                 try:
-                    final_text = escape(full_response)
+                    final_text = renderer.final()
                     if not final_text.strip():
                         final_text = get_user_text(message.from_user.id, 'error_info') + "\n" + get_user_text(message.from_user.id, 'model_empty_response')
                     await safe_edit_message(bot, final_text, sent_message.chat.id, sent_message.message_id, "MarkdownV2")
                 except Exception as e:
                     if "parse" in str(e).lower() or "entity" in str(e).lower():
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
+                        await safe_edit_message(bot, renderer.text, sent_message.chat.id, sent_message.message_id)
                     else:
                         logger.error(f"Final message update error: {e}", exc_info=True)
                 break # Success, exit loop
@@ -429,15 +938,11 @@ async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
                 logger.warning(f"Rate limit or quota exhausted: {error_str}")
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e), model_name=model_type, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    system_prompt = get_system_prompt(message.from_user.id)
-                    config_copy = generation_config.copy()
-                    config_copy['system_instruction'] = system_prompt
-                    chat = client.aio.chats.create(model=model_type, config=types.GenerateContentConfig(**config_copy))
+                    chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
                     chat_dict[user_id_str] = chat
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -448,13 +953,14 @@ async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
                 logger.error(f"Permission denied for API key: {error_str}", exc_info=True)
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_key_invalid'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, model_name=model_type, tokens=estimated_tokens)
                 
-                if not switched:
+                if not api_key:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
                 retry_count += 1
+                chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
+                chat_dict[user_id_str] = chat
 
             except google_api_exceptions.InvalidArgument as e:
                 error_str = repr(e)
@@ -469,19 +975,12 @@ async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
                 error_msg = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {error_str}\n{get_user_text(message.from_user.id, 'switching_api_key')}"
                 await safe_edit_message(bot, error_msg, sent_message.chat.id, sent_message.message_id)
 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e) if "429" in str(e) else None, model_name=model_type, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    # Re-create chat object with the new client
-                    system_prompt = get_system_prompt(message.from_user.id)
-                    config_copy = generation_config.copy()
-                    config_copy['system_instruction'] = system_prompt
-                    chat = client.aio.chats.create(
-                        model=model_type,
-                        config=types.GenerateContentConfig(**config_copy)
-                    )
+                    # Move the chat to the new key, keeping its history
+                    chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
                     chat_dict[user_id_str] = chat
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -489,37 +988,72 @@ async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
             
     except Exception as e:
         logger.error("An unhandled error occurred in gemini_stream", exc_info=True)
+        if sent_message is None and placeholder_task is not None and not placeholder_task.cancelled():
+            try:
+                sent_message = await placeholder_task
+            except Exception:
+                pass
         error_details = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {str(e)}"
         if sent_message:
             await safe_edit_message(bot, error_details, sent_message.chat.id, sent_message.message_id)
         else:
             await bot.reply_to(message, error_details)
+    finally:
+        if api_key:
+            release_api_key(api_key)
+
+async def prepare_photos(photo_file):
+    """
+    Awaits the downloads of one photo, or of a list of them for an album, together
+    and converts them to the JPEGs sent to Gemini.
+    """
+    photo_files = photo_file if isinstance(photo_file, (list, tuple)) else [photo_file]
+    async def resolve(photo):
+        return await photo if inspect.isawaitable(photo) else photo
+    resolving = [asyncio.ensure_future(resolve(photo)) for photo in photo_files]
+    try:
+        photo_files = await asyncio.gather(*resolving)
+    except BaseException:
+        # One download failed (or the request was cancelled): stop waiting for the others
+        for task in resolving:
+            task.cancel()
+        raise
+    return list(await asyncio.gather(*(prepare_image(photo) for photo in photo_files)))
 
 async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes):
     sent_message = None
+    api_key = None
     try:
         async with api_key_lock:
             if client is None:
                 await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty") )
                 return
         
-        sent_message = await bot.reply_to(message, download_pic_notify)
+        # The photos may still be downloading; send the placeholder meanwhile
+        placeholder_task = asyncio.ensure_future(bot.reply_to(message, download_pic_notify))
+        try:
+            # Decode and re-encode the photos once, off the event loop
+            images = await prepare_photos(photo_file)
+        finally:
+            sent_message = await placeholder_task
+
+        estimated_tokens = estimate_tokens(m) + IMAGE_TOKENS * len(images)
+        api_key = await lease_api_key(model_name=model_3, tokens=estimated_tokens)
+        if api_key is None:
+            await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
+            return
         
         max_retries = len(api_keys)
         retry_count = 0
+        tried_keys = set()
         while retry_count < max_retries:
             try:
-                image = Image.open(io.BytesIO(photo_file))
-                buffer = io.BytesIO()
-                image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-                
                 text_part = types.Part.from_text(text=m)
-                image_part = types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
+                image_parts = [types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg") for image_bytes in images]
                 
-                response = await client.aio.models.generate_content(
+                response = await get_pooled_client(api_key).aio.models.generate_content(
                     model=model_3,
-                    contents=[text_part, image_part],
+                    contents=[text_part] + image_parts,
                     config=types.GenerateContentConfig(**draw_generation_config)
                 )
                 
@@ -527,6 +1061,9 @@ async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes)
                     await safe_edit_message(bot, f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'no_candidates_generated')}", sent_message.chat.id, sent_message.message_id)
                     return
                 
+                if getattr(response, 'usage_metadata', None):
+                    rate_limiter.record_usage(api_key, model_3, response.usage_metadata.total_token_count, estimated_tokens)
+
                 text, img = "", None
                 for part in response.candidates[0].content.parts:
                     if part.text: text += part.text
@@ -550,10 +1087,9 @@ async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes)
                 logger.warning(f"Rate limit or quota exhausted in gemini_edit: {error_str}")
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e), model_name=model_3, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -564,10 +1100,9 @@ async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes)
                 logger.error(f"Permission denied for API key in gemini_edit: {error_str}", exc_info=True)
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_key_invalid'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, model_name=model_3, tokens=estimated_tokens)
                 
-                if not switched:
+                if not api_key:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
                 retry_count += 1
@@ -585,10 +1120,9 @@ async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes)
                 error_msg = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {error_str}\n{get_user_text(message.from_user.id, 'switching_api_key')}"
                 await safe_edit_message(bot, error_msg, sent_message.chat.id, sent_message.message_id)
 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e) if "429" in str(e) else None, model_name=model_3, tokens=estimated_tokens)
 
-                if switched:
+                if api_key:
                     retry_count += 1
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -600,27 +1134,80 @@ async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes)
             await safe_edit_message(bot, error_details, sent_message.chat.id, sent_message.message_id)
         else:
             await bot.reply_to(message, error_details)
+    finally:
+        if api_key:
+            release_api_key(api_key)
         
-async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: bytes, prompt: str = ""):
+def get_image_prompt(user_id, prompt):
+    """The prompt sent along with a photo for image understanding."""
+    if get_user_lang(user_id) == "zh" and "用中文回复" not in prompt: prompt += "，请用中文回复"
+    if not prompt: prompt = get_user_text(user_id, "describe_image_prompt")
+    return prompt
+
+def get_image_answer_cache_key(user_id, file_unique_id, prompt):
+    normalized_prompt = " ".join(get_image_prompt(user_id, prompt).split()).lower()
+    system_prompt_hash = hashlib.sha256(get_system_prompt(user_id).encode("utf-8")).hexdigest()
+    return (file_unique_id, normalized_prompt, get_current_chat_model(user_id), system_prompt_hash)
+
+async def reply_from_image_cache(bot: TeleBot, message: Message, file_unique_id: str, prompt: str = ""):
+    """Answers a photo from image_answer_cache; returns False on a cache miss."""
+    pages = image_answer_cache.get(get_image_answer_cache_key(message.from_user.id, file_unique_id, prompt))
+    if pages is None:
+        return False
     sent_message = None
+    for escaped, plain in pages:
+        reply_to = sent_message.message_id if sent_message else message.message_id
+        try:
+            sent_message = await bot.send_message(message.chat.id, escaped, parse_mode="MarkdownV2", reply_to_message_id=reply_to)
+        except Exception as e:
+            if not is_parse_error(e):
+                raise
+            sent_message = await bot.send_message(message.chat.id, plain, reply_to_message_id=reply_to)
+    return True
+
+async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: bytes, prompt: str = "", file_unique_id: str = None):
+    """`photo_file` may be a list of photos (an album), and `file_unique_id` then a tuple of their IDs."""
+    sent_message = None
+    api_key = None
+    cache_key = get_image_answer_cache_key(message.from_user.id, file_unique_id, prompt) if file_unique_id else None
+    request_started = time.monotonic()
     try:
         async with api_key_lock:
             if client is None:
                 await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty") )
                 return
             
-        sent_message = await bot.reply_to(message, download_pic_notify)
-        lang = get_user_lang(message.from_user.id)
-        
-        if lang == "zh" and "用中文回复" not in prompt: prompt += "，请用中文回复"
-        if not prompt: prompt = get_user_text(message.from_user.id, "describe_image_prompt")
+        # The photos may still be downloading; send the placeholder meanwhile
+        placeholder_task = asyncio.ensure_future(bot.reply_to(message, download_pic_notify))
+        try:
+            # Decode and re-encode the photos once, off the event loop
+            images = await prepare_photos(photo_file)
+        finally:
+            sent_message = await placeholder_task
+        prompt = get_image_prompt(message.from_user.id, prompt)
+
+        current_model_name = get_current_chat_model(message.from_user.id)
+        user_chat_dict = gemini_pro_chat_dict if "flash" in current_model_name else gemini_chat_dict
+        bound_chat, history = await user_chat_dict.restore(message.from_user.id)
+        history, trimmed = fit_history_to_budget(bound_chat, history, current_model_name, message.from_user.id, estimate_tokens(prompt) + IMAGE_TOKENS * len(images))
+        if trimmed:
+            bound_chat = None
+        estimated_tokens = estimate_tokens(prompt) + IMAGE_TOKENS * len(images) + estimate_history_tokens(history)
+        api_key = await lease_api_key(chat_api_keys.get(bound_chat) if bound_chat is not None else None, model_name=current_model_name, tokens=estimated_tokens)
+        if api_key is None:
+            await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
+            return
+        chat = bind_chat_to_key(bound_chat, api_key, current_model_name, message.from_user.id, history=history)
+        user_chat_dict[message.from_user.id] = chat
+        if trimmed:
+            await user_chat_dict.persist(message.from_user.id, chat, rewrite=True)
 
         max_retries = len(api_keys)
         retry_count = 0
+        tried_keys = set()
         while retry_count < max_retries:
             try:
                 user_id = str(message.from_user.id)
-                current_model_name = get_current_chat_model(user_id)
                 # Determine the correct chat dictionary based on the model name
                 # This part is tricky as we now have more than two models.
                 # For simplicity, we can use a single chat dictionary or create a more dynamic system.
@@ -630,60 +1217,50 @@ async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: by
                 else:
                     active_chat_dict = gemini_chat_dict
                 
-                image = Image.open(io.BytesIO(photo_file))
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                buffer = io.BytesIO()
-                image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-                
-                system_prompt = get_system_prompt(user_id)
-                
-                image_part = types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
+                image_parts = [types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg") for image_bytes in images]
                 text_part = types.Part.from_text(text=prompt)
                 
-                if user_id not in active_chat_dict:
-                    # Create a copy of the base config and add the system prompt
-                    config_copy = generation_config.copy()
-                    config_copy['system_instruction'] = system_prompt
-                    
-                    chat = client.aio.chats.create(
-                        model=current_model_name,
-                        config=types.GenerateContentConfig(**config_copy)
-                    )
-                    active_chat_dict[user_id] = chat
-                else:
-                    chat = active_chat_dict[user_id]
+                # After a failover, move the chat to the new key with its history
+                chat = bind_chat_to_key(chat, api_key, current_model_name, user_id)
+                active_chat_dict[user_id] = chat
                 
-                response_stream = await chat.send_message_stream([text_part, image_part])
+                response_stream = await chat.send_message_stream([text_part] + image_parts)
                 
-                full_response = ""
-                last_update = time.time()
-                update_interval = conf["streaming_update_interval"]
+                renderer = StreamRenderer(page_limit=conf["streaming_page_limit"])
                 
                 # --- FIX: Use the correct variable 'response_stream' ---
+                usage = None
+                chunk_count = 0
                 async for chunk in response_stream:
+                    chunk_count += 1
+                    if chunk_count == 1:
+                        record_first_token(current_model_name, request_started)
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage = chunk.usage_metadata
                     if hasattr(chunk, 'text') and chunk.text:
-                        full_response += chunk.text
-                        if time.time() - last_update >= update_interval:
-                            try:
-                                await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                            except Exception as e:
-                                if "parse" in str(e).lower() or "entity" in str(e).lower():
-                                    await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                                else:
-                                    logger.warning(f"Image understanding stream error: {e}")
-                            last_update = time.time()
+                        renderer.append(chunk.text)
+                        sent_message = await roll_over_pages(bot, message, sent_message, renderer)
+                        edit_scheduler.submit(bot, sent_message.chat.id, sent_message.message_id, renderer.render, lambda: renderer.text)
+                record_generation(current_model_name, request_started, chunk_count)
                 
+                if usage:
+                    rate_limiter.record_usage(api_key, current_model_name, usage.total_token_count, estimated_tokens)
+                    record_context_tokens(chat, usage)
+
+                # Record the turn for the session limits and on disk
+                await active_chat_dict.persist(user_id, chat)
+                if cache_key and renderer.full_text.strip():
+                    image_answer_cache.put(cache_key, [(escape(page), page) for page in renderer.pages if page.strip()])
+
                 # Final message processing
                 try:
-                    final_text = escape(full_response)
+                    final_text = renderer.final()
                     if not final_text.strip():
                         final_text = get_user_text(message.from_user.id, 'error_info') + "\n" + get_user_text(message.from_user.id, 'model_empty_response')
                     await safe_edit_message(bot, final_text, sent_message.chat.id, sent_message.message_id, "MarkdownV2")
                 except Exception as e:
                     if "parse" in str(e).lower() or "entity" in str(e).lower():
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
+                        await safe_edit_message(bot, renderer.text, sent_message.chat.id, sent_message.message_id)
                     else:
                         logger.error(f"Final image understanding message update error: {e}", exc_info=True)
                 break
@@ -693,12 +1270,11 @@ async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: by
                 logger.warning(f"Rate limit or quota exhausted in gemini_image_understand: {error_str}")
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e), model_name=current_model_name, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    if user_id in active_chat_dict: del active_chat_dict[user_id]
+                    # The chat moves to the new key with its history at the top of the loop
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
@@ -708,14 +1284,13 @@ async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: by
                 logger.error(f"Permission denied for API key in gemini_image_understand: {error_str}", exc_info=True)
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_key_invalid'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, model_name=current_model_name, tokens=estimated_tokens)
                 
-                if not switched:
+                if not api_key:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
                 retry_count += 1
-                if user_id in active_chat_dict: del active_chat_dict[user_id]
+                # The chat moves to the new key with its history at the top of the loop
 
             except google_api_exceptions.InvalidArgument as e:
                 error_str = repr(e)
@@ -730,12 +1305,11 @@ async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: by
                 error_msg = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {error_str}\n{get_user_text(message.from_user.id, 'switching_api_key')}"
                 await safe_edit_message(bot, error_msg, sent_message.chat.id, sent_message.message_id)
 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e) if "429" in str(e) else None, model_name=current_model_name, tokens=estimated_tokens)
 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    if user_id in active_chat_dict: del active_chat_dict[user_id]
+                    # The chat moves to the new key with its history at the top of the loop
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
@@ -747,23 +1321,74 @@ async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: by
             await safe_edit_message(bot, error_details, sent_message.chat.id, sent_message.message_id)
         else:
             await bot.reply_to(message, error_details)
-
+    finally:
+        if api_key:
+            release_api_key(api_key)
+
+
+def get_draw_cache_key(prompt):
+    config_hash = hashlib.sha256(repr(sorted(draw_generation_config.items())).encode("utf-8")).hexdigest()
+    return (prompt.strip(), model_3, config_hash)
+
+async def send_draw_result(bot: TeleBot, chat_id, photo, text):
+    """Sends a drawn image (bytes or a Telegram file_id) and its text; returns the file_id of the photo."""
+    file_id = None
+    if photo:
+        photo_message = await bot.send_photo(chat_id, io.BytesIO(photo) if isinstance(photo, bytes) else photo)
+        file_id = photo_message.photo[-1].file_id if getattr(photo_message, 'photo', None) else None
+    if text:
+        try:
+            await bot.send_message(chat_id, escape(text), parse_mode="MarkdownV2")
+        except Exception as e:
+            if "parse" in str(e).lower() or "entity" in str(e).lower():
+                await bot.send_message(chat_id, text)
+            else:
+                raise e
+    return file_id
+
+async def reply_from_draw_cache(bot: TeleBot, message: Message, prompt: str):
+    """Resends a drawing of `prompt` from draw_cache; returns False on a cache miss."""
+    cache_key = get_draw_cache_key(prompt)
+    cached = draw_cache.get(cache_key)
+    if cached is None:
+        return False
+    try:
+        await send_draw_result(bot, message.chat.id, *cached)
+        return True
+    except Exception as e:
+        # The file_id may no longer be valid, draw the image again
+        logger.warning(f"Failed to resend cached drawing: {e}")
+        draw_cache.pop(cache_key)
+        return False
 
 async def gemini_draw(bot:TeleBot, message:Message, m:str):
     sent_message = None
+    api_key = None
+    cache_key = get_draw_cache_key(m)
     try:
         async with api_key_lock:
             if client is None:
                 await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty") )
                 return
-            
+
+        # The same prompt may have been drawn while this request waited for its slot
+        if await reply_from_draw_cache(bot, message, m):
+            return
+
         sent_message = await bot.reply_to(message, get_user_text(message.from_user.id, "drawing_message") )
+
+        estimated_tokens = estimate_tokens(m)
+        api_key = await lease_api_key(model_name=model_3, tokens=estimated_tokens)
+        if api_key is None:
+            await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
+            return
             
         max_retries = len(api_keys)
         retry_count = 0
+        tried_keys = set()
         while retry_count < max_retries:
             try:
-                response = await client.aio.models.generate_content(
+                response = await get_pooled_client(api_key).aio.models.generate_content(
                     model=model_3,
                     contents=m,
                     config=types.GenerateContentConfig(**draw_generation_config)
@@ -773,20 +1398,18 @@ async def gemini_draw(bot:TeleBot, message:Message, m:str):
                     await safe_edit_message(bot, f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'no_candidates_generated')}", sent_message.chat.id, sent_message.message_id)
                     break
                 
+                if getattr(response, 'usage_metadata', None):
+                    rate_limiter.record_usage(api_key, model_3, response.usage_metadata.total_token_count, estimated_tokens)
+
                 text, img = "", None
                 for part in response.candidates[0].content.parts:
                     if part.text: text += part.text
                     if part.inline_data: img = part.inline_data.data
                 
-                if img: await bot.send_photo(message.chat.id, io.BytesIO(img))
-                if text:
-                    try:
-                        await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
-                    except Exception as e:
-                        if "parse" in str(e).lower() or "entity" in str(e).lower():
-                            await bot.send_message(message.chat.id, text)
-                        else:
-                            raise e
+                file_id = await send_draw_result(bot, message.chat.id, img, text)
+                if file_id:
+                    # Later requests for the same prompt resend the uploaded photo by its file_id
+                    draw_cache.put(cache_key, (file_id, text))
                 
                 try: await bot.delete_message(chat_id=sent_message.chat.id, message_id=sent_message.message_id)
                 except Exception: pass
@@ -797,10 +1420,9 @@ async def gemini_draw(bot:TeleBot, message:Message, m:str):
                 logger.warning(f"Rate limit or quota exhausted in gemini_draw: {error_str}")
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e), model_name=model_3, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -811,10 +1433,9 @@ async def gemini_draw(bot:TeleBot, message:Message, m:str):
                 logger.error(f"Permission denied for API key in gemini_draw: {error_str}", exc_info=True)
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_key_invalid'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, model_name=model_3, tokens=estimated_tokens)
                 
-                if not switched:
+                if not api_key:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
                 retry_count += 1
@@ -832,10 +1453,9 @@ async def gemini_draw(bot:TeleBot, message:Message, m:str):
                 error_msg = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {error_str}\n{get_user_text(message.from_user.id, 'switching_api_key')}"
                 await safe_edit_message(bot, error_msg, sent_message.chat.id, sent_message.message_id)
 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e) if "429" in str(e) else None, model_name=model_3, tokens=estimated_tokens)
 
-                if switched:
+                if api_key:
                     retry_count += 1
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -848,6 +1468,9 @@ async def gemini_draw(bot:TeleBot, message:Message, m:str):
             await safe_edit_message(bot, error_details, sent_message.chat.id, sent_message.message_id)
         else:
             await bot.reply_to(message, error_details)
+    finally:
+        if api_key:
+            release_api_key(api_key)
 
 async def switch_model_and_inherit_history(user_id):
     """
@@ -870,28 +1493,20 @@ async def switch_model_and_inherit_history(user_id):
 
     # Get history from the old chat, if it exists
     history = []
-    if user_id_str in switchable_chat_sessions:
-        try:
-            # Accessing history might be complex depending on the library's async implementation
-            # Assuming a synchronous accessor for simplicity or that it's readily available
-            old_chat = switchable_chat_sessions[user_id_str]
-            if hasattr(old_chat, 'history'):
-                history = old_chat.history
-        except Exception as e:
-            logger.error(f"Could not retrieve history for user {user_id_str}: {e}")
+    old_chat = None
+    try:
+        old_chat, history = await switchable_chat_sessions.restore(user_id_str)
+    except Exception as e:
+        logger.error(f"Could not retrieve history for user {user_id_str}: {e}")
+
+    # Keep the session on the key it is bound to, falling back to the default key
+    api_key = chat_api_keys.get(old_chat) if old_chat is not None else None
+    if api_key not in api_keys:
+        api_key = get_current_api_key()
 
     # Create a new chat with the new model and the old history
-    system_prompt = get_system_prompt(user_id)
     try:
-        # Create a copy of the base config and add the system prompt
-        config_copy = generation_config.copy()
-        config_copy['system_instruction'] = system_prompt
-        
-        new_chat = client.aio.chats.create(
-            model=new_model_name,
-            history=history,
-            config=types.GenerateContentConfig(**config_copy)
-        )
+        new_chat = create_chat(api_key, new_model_name, user_id, history=history)
         switchable_chat_sessions[user_id_str] = new_chat
         logger.info(f"User {user_id_str} switched to model {new_model_name} inheriting {len(history)} messages.")
     except Exception as e:
@@ -904,84 +1519,99 @@ async def switch_model_and_inherit_history(user_id):
 
 async def gemini_stream_switchable(bot:TeleBot, message:Message, m:str, model_type:str):
     sent_message = None
+    api_key = None
+    placeholder_task = None
     try:
         # Lock before checking for client to prevent race conditions
         async with api_key_lock:
             if client is None:
                 await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty") )
                 return
-            
-        sent_message = await bot.reply_to(message, get_user_text(message.from_user.id, "generating_answer"))
+ 
+        # Send the placeholder while the model request is being set up and sent
+        request_started = time.monotonic()
+        placeholder_task = asyncio.ensure_future(bot.reply_to(message, get_user_text(message.from_user.id, "generating_answer")))
 
         chat_dict = switchable_chat_sessions
         user_id_str = str(message.from_user.id)
 
-        # Initialize chat outside the retry loop but after the client check
-        if user_id_str not in chat_dict:
-            system_prompt = get_system_prompt(message.from_user.id)
-            try:
-                # Create a copy of the base config and add the system prompt
-                config_copy = generation_config.copy()
-                config_copy['system_instruction'] = system_prompt
-                
-                chat = client.aio.chats.create(
-                    model=model_type,
-                    config=types.GenerateContentConfig(**config_copy)
-                )
-                chat_dict[user_id_str] = chat
-            except Exception as e:
-                logger.error(f"Failed to set system prompt: {e}")
-                chat = client.aio.chats.create(
-                    model=model_type,
-                    config=types.GenerateContentConfig(**generation_config)
-                )
-                chat_dict[user_id_str] = chat
-        else:
-            chat = chat_dict[user_id_str]
+        # Lease a key, preferring the one the user's chat is bound to
+        chat, history = await chat_dict.restore(user_id_str)
+        history, summarized = apply_history_summary(user_id_str, history)
+        if summarized:
+            chat = None
+        history, trimmed = fit_history_to_budget(chat, history, model_type, message.from_user.id, estimate_tokens(m))
+        if trimmed:
+            chat = None
+        estimated_tokens = estimate_tokens(m) + estimate_history_tokens(history)
+        api_key = await lease_api_key(chat_api_keys.get(chat) if chat is not None else None, model_name=model_type, tokens=estimated_tokens)
+        if api_key is None:
+            sent_message = await placeholder_task
+            await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
+            return
+        chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id, history=history)
+        chat_dict[user_id_str] = chat
+        if summarized or trimmed:
+            await chat_dict.persist(user_id_str, chat, rewrite=True)
             
         lang = get_user_lang(message.from_user.id)
         if lang == "zh" and "用中文回复" not in m: m += "，请用中文回复"
 
         retry_count = 0
+        tried_keys = set()
         # Use a copy of api_keys length for stable loop bound
         max_retries = len(api_keys)
         while retry_count < max_retries:
             try:
-                response = await chat.send_message_stream(m)
-                full_response = ""
-                last_update = time.time()
-                update_interval = conf["streaming_update_interval"]
-
+                response_task = asyncio.ensure_future(chat.send_message_stream(m))
+                if sent_message is None:
+                    try:
+                        sent_message = await placeholder_task
+                    except BaseException:
+                        response_task.cancel()
+                        raise
+                response = await response_task
+                renderer = StreamRenderer(page_limit=conf["streaming_page_limit"])
+
+                usage = None
+                chunk_count = 0
                 async for chunk in response:
+                    chunk_count += 1
+                    if chunk_count == 1:
+                        record_first_token(model_type, request_started)
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage = chunk.usage_metadata
                     for part in chunk.candidates[0].content.parts:
                         if part.text:
-                            full_response += part.text
+                            renderer.append(part.text)
                         if hasattr(part, 'executable_code') and part.executable_code:
                             code_to_display = f"\n\n> **Executing Code:**\n```python\n{part.executable_code.code}\n```"
-                            full_response += code_to_display
+                            renderer.append(code_to_display)
                         if hasattr(part, 'code_execution_result') and part.code_execution_result:
                             result_to_display = f"\n\n> **Result:**\n{part.code_execution_result.output}\n"
-                            full_response += result_to_display
+                            renderer.append(result_to_display)
                     
-                    if time.time() - last_update >= update_interval:
-                        try:
-                            await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                        except Exception as e:
-                            if "parse" in str(e).lower() or "entity" in str(e).lower():
-                                await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                            else:
-                                logger.warning(f"Error updating message during stream: {e}")
-                        last_update = time.time()
+                    sent_message = await roll_over_pages(bot, message, sent_message, renderer)
+                    edit_scheduler.submit(bot, sent_message.chat.id, sent_message.message_id, renderer.render, lambda: renderer.text)
+                record_generation(model_type, request_started, chunk_count)
+
+                if usage:
+                    rate_limiter.record_usage(api_key, model_type, usage.total_token_count, estimated_tokens)
+                    record_context_tokens(chat, usage)
+
+                # Record the turn for the session limits and on disk
+                await chat_dict.persist(user_id_str, chat)
+                schedule_history_summary(user_id_str, chat)
 
                 # Final message processing
                 try:
-                    final_text = escape(full_response)
+                    final_text = renderer.final()
                     if not final_text.strip():
                         final_text = get_user_text(message.from_user.id, 'error_info') + "\n" + get_user_text(message.from_user.id, 'model_empty_response')
                     await safe_edit_message(bot, final_text, sent_message.chat.id, sent_message.message_id, "MarkdownV2")
                 except Exception as e:
                     if "parse" in str(e).lower() or "entity" in str(e).lower():
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
+                        await safe_edit_message(bot, renderer.text, sent_message.chat.id, sent_message.message_id)
                     else:
                         logger.error(f"Final message update error: {e}", exc_info=True)
                 break # Success, exit loop
@@ -991,15 +1621,11 @@ async def gemini_stream_switchable(bot:TeleBot, message:Message, m:str, model_ty
                 logger.warning(f"Rate limit or quota exhausted: {error_str}")
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e), model_name=model_type, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    system_prompt = get_system_prompt(message.from_user.id)
-                    config_copy = generation_config.copy()
-                    config_copy['system_instruction'] = system_prompt
-                    chat = client.aio.chats.create(model=model_type, config=types.GenerateContentConfig(**config_copy))
+                    chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
                     chat_dict[user_id_str] = chat
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -1010,13 +1636,14 @@ async def gemini_stream_switchable(bot:TeleBot, message:Message, m:str, model_ty
                 logger.error(f"Permission denied for API key: {error_str}", exc_info=True)
                 await safe_edit_message(bot, get_user_text(message.from_user.id, 'api_key_invalid'), sent_message.chat.id, sent_message.message_id)
                 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, model_name=model_type, tokens=estimated_tokens)
                 
-                if not switched:
+                if not api_key:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
                     break
                 retry_count += 1
+                chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
+                chat_dict[user_id_str] = chat
 
             except google_api_exceptions.InvalidArgument as e:
                 error_str = repr(e)
@@ -1031,19 +1658,12 @@ async def gemini_stream_switchable(bot:TeleBot, message:Message, m:str, model_ty
                 error_msg = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {error_str}\n{get_user_text(message.from_user.id, 'switching_api_key')}"
                 await safe_edit_message(bot, error_msg, sent_message.chat.id, sent_message.message_id)
 
-                async with api_key_lock:
-                    switched = switch_to_next_api_key()
+                api_key = await failover_api_key(api_key, tried_keys, cooldown=get_cooldown_from_exc(e) if "429" in str(e) else None, model_name=model_type, tokens=estimated_tokens)
                 
-                if switched:
+                if api_key:
                     retry_count += 1
-                    # Re-create chat object with the new client
-                    system_prompt = get_system_prompt(message.from_user.id)
-                    config_copy = generation_config.copy()
-                    config_copy['system_instruction'] = system_prompt
-                    chat = client.aio.chats.create(
-                        model=model_type,
-                        config=types.GenerateContentConfig(**config_copy)
-                    )
+                    # Move the chat to the new key, keeping its history
+                    chat = bind_chat_to_key(chat, api_key, model_type, message.from_user.id)
                     chat_dict[user_id_str] = chat
                 else:
                     await safe_edit_message(bot, get_user_text(message.from_user.id, 'all_api_quota_exhausted'), sent_message.chat.id, sent_message.message_id)
@@ -1051,8 +1671,16 @@ async def gemini_stream_switchable(bot:TeleBot, message:Message, m:str, model_ty
             
     except Exception as e:
         logger.error("An unhandled error occurred in gemini_stream", exc_info=True)
+        if sent_message is None and placeholder_task is not None and not placeholder_task.cancelled():
+            try:
+                sent_message = await placeholder_task
+            except Exception:
+                pass
         error_details = f"{get_user_text(message.from_user.id, 'error_info')}\n{get_user_text(message.from_user.id, 'error_details')} {str(e)}"
         if sent_message:
             await safe_edit_message(bot, error_details, sent_message.chat.id, sent_message.message_id)
         else:
             await bot.reply_to(message, error_details)
+    finally:
+        if api_key:
+            release_api_key(api_key)
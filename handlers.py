@@ -3,10 +3,15 @@ from telebot.types import Message, BotCommand
 from md2tgmd import escape
 import json
 import os
+import asyncio
 from functools import wraps
 import config
 from config import conf, lang_settings, USER_DATA_FILE
 import gemini
+from images import select_photo_size
+from request_limiter import RequestLimiter, MessageCoalescer
+from menus import MenuRegistry
+import metrics
 import time
 import re
 import logging
@@ -25,6 +30,9 @@ from gemini import (
 
 # --- Menu Definitions ---
 
+# Remembers the menu last set per user, so unchanged menus are not set again at startup
+menu_registry = MenuRegistry(conf.get("menu_state_file", "menu_state.json"))
+
 admin_menu_zh = [
     BotCommand("start", "开始"),
     BotCommand("gemini", f"模型 {conf['model_2']}"),
@@ -93,7 +101,21 @@ user_menu_en = [
 
 # --- User and Admin Management ---
 
-def load_authorized_users():
+# In-process authorized user registry. The file is only re-read when its mtime
+# changes (checked at most every `user_registry_check_interval` seconds) or when
+# a reload is forced, so authorization does not hit the disk on every message.
+_authorized_users = None
+_authorized_users_mtime = None
+_authorized_users_checked_at = 0.0
+_authorized_users_write_lock = asyncio.Lock()
+
+def _get_user_file_mtime():
+    try:
+        return os.stat(USER_DATA_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+def _read_authorized_users_file():
     if os.path.exists(USER_DATA_FILE):
         try:
             with open(USER_DATA_FILE, 'r') as f:
@@ -102,9 +124,54 @@ def load_authorized_users():
             return set(config.ADMIN_UID)
     return set(config.ADMIN_UID)
 
-def save_authorized_users(users):
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(list(users), f, indent=4)
+def load_authorized_users(force_reload=False):
+    """Returns the cached set of authorized user IDs, reloading it if the file changed."""
+    global _authorized_users, _authorized_users_mtime, _authorized_users_checked_at
+    now = time.monotonic()
+    if _authorized_users is not None and not force_reload:
+        if now - _authorized_users_checked_at < conf.get("user_registry_check_interval", 5):
+            return _authorized_users
+        _authorized_users_checked_at = now
+        if _get_user_file_mtime() == _authorized_users_mtime:
+            return _authorized_users
+
+    mtime = _get_user_file_mtime()
+    users = _read_authorized_users_file()
+    if _authorized_users is None:
+        _authorized_users = users
+    else:
+        # Update in place so references held by callers stay valid
+        _authorized_users.clear()
+        _authorized_users.update(users)
+    _authorized_users_mtime = mtime
+    _authorized_users_checked_at = now
+    return _authorized_users
+
+def reload_authorized_users():
+    return load_authorized_users(force_reload=True)
+
+def is_authorized_user(user_id):
+    return user_id in load_authorized_users()
+
+def _write_authorized_users_file(users):
+    # Write to a temporary file and atomically replace, so readers never see a partial file
+    tmp_path = f"{USER_DATA_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(users, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, USER_DATA_FILE)
+    return _get_user_file_mtime()
+
+async def save_authorized_users(users):
+    """Persists the user registry off the event loop."""
+    global _authorized_users_mtime
+    snapshot = sorted(users)
+    async with _authorized_users_write_lock:
+        mtime = await asyncio.to_thread(_write_authorized_users_file, snapshot)
+    # Our own write must not trigger a reload on the next check
+    if _authorized_users is users:
+        _authorized_users_mtime = mtime
 
 def is_admin(user_id):
     return user_id in config.ADMIN_UID
@@ -115,7 +182,7 @@ def authorized_user_only(func):
     @wraps(func)
     async def wrapped(message: Message, bot: TeleBot, *args, **kwargs):
         user_id = message.from_user.id
-        if user_id not in load_authorized_users():
+        if not is_authorized_user(user_id):
             logger.warning(f"Unauthorized access attempt by user_id: {user_id}")
             await bot.reply_to(message, "🚫 You do not have permission to use this bot.")
             return
@@ -132,6 +199,61 @@ def admin_only(func):
         return await func(message, bot, *args, **kwargs)
     return wrapped
 
+# One generation per user and session at a time, and a global cap with a bounded wait
+request_limiter = RequestLimiter(conf)
+metrics.generations.set_function(lambda: {("active",): request_limiter.active, ("waiting",): request_limiter.waiting,
+                                           ("queued",): request_limiter.queued})
+
+# Bursts of private text messages answered as one
+message_coalescer = MessageCoalescer()
+
+# Photos of an album (media group) arrive as separate messages and are answered as one
+media_group_coalescer = MessageCoalescer()
+
+def generation_limited(get_session):
+    """
+    Runs the handler in the user's queue for the session returned by `get_session(message)`,
+    within the global generation limit. Replies "busy" right away when the wait queue or
+    the user's own queue is full.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapped(message: Message, bot: TeleBot, *args, **kwargs):
+            if request_limiter.is_user_busy(message.from_user.id):
+                logger.warning(f"Too many queued generations of user_id: {message.from_user.id}")
+                await bot.reply_to(message, get_user_text(message.from_user.id, "busy_user"))
+                return
+            if request_limiter.is_busy():
+                logger.warning(f"Too many queued generations, turning away user_id: {message.from_user.id}")
+                await bot.reply_to(message, get_user_text(message.from_user.id, "busy"))
+                return
+            async with request_limiter.slot(message.from_user.id, get_session(message)):
+                return await func(message, bot, *args, **kwargs)
+        return wrapped
+    return decorator
+
+# Sessions whose chats /clear and the system prompt commands drop
+CHAT_SESSIONS = ("draw", "gemini", "gemini_pro", "switchable")
+
+def sessions_locked(sessions):
+    """
+    Runs the handler once the user's generations in `sessions` have finished, and keeps
+    new ones waiting meanwhile, so a chat is not replaced while a turn is recorded on it.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapped(message: Message, bot: TeleBot, *args, **kwargs):
+            async with request_limiter.user_lock(message.from_user.id, sessions):
+                return await func(message, bot, *args, **kwargs)
+        return wrapped
+    return decorator
+
+def get_photo_session(message: Message) -> str:
+    """Image understanding continues the chat of the current model; /edit has no chat."""
+    if message.chat.type == "private" and not (message.caption or "").startswith("/"):
+        return "gemini_pro" if "flash" in get_current_chat_model(message.from_user.id) else "gemini"
+    return "edit"
+
 # --- Bot Handlers ---
 
 gemini_chat_dict = gemini.gemini_chat_dict
@@ -156,11 +278,12 @@ async def language_switch_handler(message: Message, bot: TeleBot) -> None:
     else:
         menu_to_set = user_menu_zh if new_lang == 'zh' else user_menu_en
     try:
-        await bot.set_my_commands(menu_to_set, scope=telebot.types.BotCommandScopeChat(chat_id=user_id))
+        await menu_registry.set_menu(bot, menu_to_set, user_id)
     except Exception as e:
         logger.error(f"Failed to set commands for user {user_id}: {e}")
 
 @authorized_user_only
+@generation_limited(lambda message: "gemini_pro")  # model_2 chats live in gemini_pro_chat_dict
 async def gemini_stream_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /gemini received from user_id: {message.from_user.id}")
     try:
@@ -172,6 +295,7 @@ async def gemini_stream_handler(message: Message, bot: TeleBot) -> None:
     await gemini.gemini_stream(bot, message, m, conf['model_2'])
 
 @authorized_user_only
+@generation_limited(lambda message: "gemini")  # model_1 chats live in gemini_chat_dict
 async def gemini_pro_stream_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /gemini_pro received from user_id: {message.from_user.id}")
     try:
@@ -183,16 +307,15 @@ async def gemini_pro_stream_handler(message: Message, bot: TeleBot) -> None:
     await gemini.gemini_stream(bot, message, m, conf['model_1'])
 
 @authorized_user_only
+@sessions_locked(CHAT_SESSIONS)
 async def clear(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /clear received from user_id: {message.from_user.id}")
     user_id_str = str(message.from_user.id)
-    if user_id_str in gemini_chat_dict: del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict: del gemini_pro_chat_dict[user_id_str]
-    if user_id_str in switchable_chat_sessions: del switchable_chat_sessions[user_id_str]
-    if user_id_str in gemini_draw_dict: del gemini_draw_dict[user_id_str]
+    await gemini.session_store.clear_user(user_id_str)
     await bot.reply_to(message, get_user_text(message.from_user.id, "history_cleared"))
 
 @authorized_user_only
+@sessions_locked(("switchable",))
 async def switch(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /switch received from user_id: {message.from_user.id}")
     if message.chat.type != "private":
@@ -216,26 +339,82 @@ async def language_status_handler(message: Message, bot: TeleBot) -> None:
 @authorized_user_only
 async def gemini_private_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"gemini_private_handler processing text from user_id: {message.from_user.id}")
-    m = message.text.strip()
-    user_id = message.from_user.id
-    model_to_use = get_current_chat_model(user_id)
+    window = conf.get("message_coalesce_window_ms", 0) / 1000
+    if window > 0:
+        # Messages following each other within the window are answered together
+        messages = await message_coalescer.collect((message.chat.id, message.from_user.id), message, window)
+        if messages is None:
+            return
+        if len(messages) > 1:
+            logger.info(f"Coalesced {len(messages)} messages from user_id: {message.from_user.id}")
+        m = "\n".join(msg.text.strip() for msg in messages)
+    else:
+        m = message.text.strip()
+    await answer_private_text(message, bot, m)
+
+@generation_limited(lambda message: "switchable")
+async def answer_private_text(message: Message, bot: TeleBot, m: str) -> None:
+    model_to_use = get_current_chat_model(message.from_user.id)
     # Use the dedicated stream handler for switchable chats
     await gemini.gemini_stream_switchable(bot, message, m, model_to_use)
 
+async def download_photo(bot: TeleBot, file_id: str) -> bytes:
+    started = time.monotonic()
+    file_path = await bot.get_file(file_id)
+    data = await bot.download_file(file_path.file_path)
+    metrics.image_download_seconds.observe(time.monotonic() - started)
+    metrics.image_bytes.inc(len(data), stage="downloaded")
+    return data
+
 @authorized_user_only
 async def gemini_photo_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"gemini_photo_handler received photo from user_id: {message.from_user.id}")
+    messages = [message]
+    if message.media_group_id and conf.get("media_group_window_ms", 0) > 0:
+        # Wait for the rest of the album; its first message answers for all of them
+        messages = await media_group_coalescer.collect(
+            message.media_group_id, message, conf["media_group_window_ms"] / 1000)
+        if messages is None:
+            return
+        logger.info(f"Collected {len(messages)} photos of media group {message.media_group_id}")
+        # Telegram puts an album's caption on one of its messages, usually the first
+        message.caption = next((msg.caption for msg in messages if msg.caption), None)
+    s = message.caption or ""
+    photos = [select_photo_size(msg.photo) for msg in messages]
+    file_unique_id = photos[0].file_unique_id if len(photos) == 1 else tuple(photo.file_unique_id for photo in photos)
+    if message.chat.type == "private" and not s.startswith("/"):
+        # The same photos with the same prompt are answered without downloading them again,
+        # and without waiting for a generation slot since the model is not called
+        try:
+            if await gemini.reply_from_image_cache(bot, message, file_unique_id, prompt=s):
+                return
+        except Exception:
+            logger.error("Failed to answer photo from the cache", exc_info=True)
+    await answer_photos(message, bot, photos, file_unique_id)
+
+@generation_limited(get_photo_session)
+async def answer_photos(message: Message, bot: TeleBot, photos: list, file_unique_id) -> None:
     s = message.caption or ""
     try:
-        file_path = await bot.get_file(message.photo[-1].file_id)
-        photo_file = await bot.download_file(file_path.file_path)
-        if message.chat.type == "private" and not s.startswith("/"):
-            await gemini.gemini_image_understand(bot, message, photo_file, prompt=s)
-        else:
-            m = s.strip().split(maxsplit=1)[1].strip() if s.startswith("/edit") and len(s.strip().split(maxsplit=1)) > 1 else s
-            await gemini.gemini_edit(bot, message, m, photo_file)
+        # Start the downloads now; the model functions await them while their placeholder is sent
+        photo_files = [asyncio.ensure_future(download_photo(bot, photo.file_id)) for photo in photos]
+        photo_file = photo_files[0] if len(photo_files) == 1 else photo_files
+        try:
+            if message.chat.type == "private" and not s.startswith("/"):
+                await gemini.gemini_image_understand(bot, message, photo_file, prompt=s, file_unique_id=file_unique_id)
+            else:
+                m = s.strip().split(maxsplit=1)[1].strip() if s.startswith("/edit") and len(s.strip().split(maxsplit=1)) > 1 else s
+                await gemini.gemini_edit(bot, message, m, photo_file)
+        finally:
+            # The model functions may return before awaiting every download
+            # (no client, or another photo of the album failed)
+            for task in photo_files:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception():
+                    logger.warning(f"Photo download failed: {task.exception()}")
     except Exception:
-        logger.error("An error occurred in gemini_photo_handler", exc_info=True)
+        logger.error("An error occurred in answer_photos", exc_info=True)
         await bot.reply_to(message, get_user_text(message.from_user.id, "error_info"))
 
 @authorized_user_only
@@ -243,11 +422,23 @@ async def draw_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /draw received from user_id: {message.from_user.id}")
     try:
         m = message.text.strip().split(maxsplit=1)[1].strip()
-        await gemini.gemini_draw(bot, message, m)
     except IndexError:
         await bot.reply_to(message, get_user_text(message.from_user.id, "draw_prompt_help"))
+        return
+    # A cached drawing is resent without waiting for a generation slot since the model is not called
+    try:
+        if await gemini.reply_from_draw_cache(bot, message, m):
+            return
+    except Exception:
+        logger.error("Failed to answer /draw from the cache", exc_info=True)
+    await draw(message, bot, m)
+
+@generation_limited(lambda message: "draw")
+async def draw(message: Message, bot: TeleBot, m: str) -> None:
+    await gemini.gemini_draw(bot, message, m)
 
 @admin_only
+@sessions_locked(CHAT_SESSIONS)
 async def system_prompt_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /system received from admin_id: {message.from_user.id}")
     try:
@@ -258,11 +449,13 @@ async def system_prompt_handler(message: Message, bot: TeleBot) -> None:
         await bot.reply_to(message, help_msg)
 
 @admin_only
+@sessions_locked(CHAT_SESSIONS)
 async def system_prompt_clear_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /system_clear received from admin_id: {message.from_user.id}")
     await delete_system_prompt(bot, message)
 
 @admin_only
+@sessions_locked(CHAT_SESSIONS)
 async def system_prompt_reset_handler(message: Message, bot: TeleBot) -> None:
     logger.info(f"Command /system_reset received from admin_id: {message.from_user.id}")
     await reset_system_prompt(bot, message)
@@ -282,7 +475,7 @@ async def add_user(message: Message, bot: TeleBot):
             await bot.reply_to(message, f"⚠️ User {user_to_add} is already authorized.")
             return
         users.add(user_to_add)
-        save_authorized_users(users)
+        await save_authorized_users(users)
         await bot.reply_to(message, f"✅ User {user_to_add} has been added successfully.")
     except (IndexError, ValueError):
         await bot.reply_to(message, "⚠️ Incorrect command format. Use /adduser <user_id>")
@@ -300,7 +493,7 @@ async def del_user(message: Message, bot: TeleBot):
             await bot.reply_to(message, f"⚠️ User {user_to_del} is not found.")
             return
         users.discard(user_to_del)
-        save_authorized_users(users)
+        await save_authorized_users(users)
         await bot.reply_to(message, f"✅ User {user_to_del} has been removed.")
     except (IndexError, ValueError):
         await bot.reply_to(message, "⚠️ Incorrect command format. Use /deluser <user_id>")
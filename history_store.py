@@ -0,0 +1,87 @@
+import sqlite3
+import asyncio
+import logging
+import threading
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """
+    Chat histories on disk, in SQLite, one row per message.
+
+    Rows are keyed by (user_id, session, seq), where session is the chat type
+    (the SessionStore namespace). New messages are appended after each turn; a
+    history that was shortened or rewritten replaces the stored one. All methods
+    that touch the database block, and have async wrappers running in a thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "user_id TEXT NOT NULL, session TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "content TEXT NOT NULL, PRIMARY KEY (user_id, session, seq))"
+        )
+        self._conn.commit()
+
+    def load(self, session, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content FROM history WHERE user_id = ? AND session = ? ORDER BY seq",
+                (str(user_id), session),
+            ).fetchall()
+        history = []
+        for (content,) in rows:
+            try:
+                history.append(types.Content.model_validate_json(content))
+            except Exception as e:
+                logger.error(f"Dropping unreadable history entry of user {user_id}: {e}")
+        return history
+
+    def save(self, session, user_id, history, rewrite=False):
+        """Appends the messages of `history` not stored yet, or replaces the stored history if `rewrite`."""
+        user_id = str(user_id)
+        with self._lock, self._conn:
+            if rewrite:
+                self._conn.execute("DELETE FROM history WHERE user_id = ? AND session = ?", (user_id, session))
+                stored = 0
+            else:
+                stored = self._conn.execute(
+                    "SELECT COUNT(*) FROM history WHERE user_id = ? AND session = ?", (user_id, session)
+                ).fetchone()[0]
+                if stored > len(history):
+                    # History got shorter than what is on disk, store it afresh
+                    self._conn.execute("DELETE FROM history WHERE user_id = ? AND session = ?", (user_id, session))
+                    stored = 0
+            self._conn.executemany(
+                "INSERT INTO history (user_id, session, seq, content) VALUES (?, ?, ?, ?)",
+                [(user_id, session, seq, content.model_dump_json(exclude_none=True))
+                 for seq, content in enumerate(history[stored:], stored)],
+            )
+
+    def delete(self, user_id, session=None):
+        user_id = str(user_id)
+        with self._lock, self._conn:
+            if session is None:
+                self._conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            else:
+                self._conn.execute("DELETE FROM history WHERE user_id = ? AND session = ?", (user_id, session))
+
+    async def load_async(self, session, user_id):
+        return await asyncio.to_thread(self.load, session, user_id)
+
+    async def save_async(self, session, user_id, history, rewrite=False):
+        await asyncio.to_thread(self.save, session, user_id, history, rewrite)
+
+    async def delete_async(self, user_id, session=None):
+        await asyncio.to_thread(self.delete, user_id, session)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,99 @@
+import io
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def select_photo_size(photos, max_side=None):
+    """
+    Picks which of Telegram's sizes of a photo (message.photo) to download: the largest
+    one with a longer side between half of `max_side` and `max_side` (what _to_jpeg would
+    scale a larger one down to), else the smallest larger one, else the largest one.
+    """
+    max_side = max_side or conf.get("image_max_side")
+    largest = max(photos, key=lambda p: p.width * p.height)
+    if not max_side:
+        return largest
+    fitting = [p for p in photos if max_side / 2 <= max(p.width, p.height) <= max_side]
+    if fitting:
+        return max(fitting, key=lambda p: p.width * p.height)
+    larger = [p for p in photos if max(p.width, p.height) > max_side]
+    if larger:
+        return min(larger, key=lambda p: p.width * p.height)
+    return largest
+
+
+def get_image_executor():
+    """The pool running Pillow work, a thread or process pool per conf["image_pool_type"]."""
+    global _executor
+    if _executor is None:
+        workers = conf.get("image_pool_size", 2)
+        if conf.get("image_pool_type", "thread") == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    return _executor
+
+
+def shutdown_image_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _to_jpeg(data, max_side):
+    """
+    Makes a JPEG of at most `max_side` pixels on its longer side from an image.
+    Runs in the pool; returns (bytes, seconds decoding and scaling, seconds encoding),
+    with None for bytes that can be sent as they are.
+
+    Only the header is read first: a JPEG that is already small enough is returned
+    as is. Oversized JPEGs are scaled down by 1/2, 1/4 or 1/8 while decoding (draft
+    mode), to a longer side of at least half of `max_side`, which is much cheaper
+    than resampling the full image; only what is still too large gets resampled.
+    """
+    started = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    fits = not max_side or max(image.size) <= max_side
+    if image.format == "JPEG" and image.mode in ("RGB", "L") and fits:
+        return None, time.perf_counter() - started, 0.0
+    if not fits:
+        if image.format == "JPEG":
+            scale = max_side / 2 / max(image.size)
+            image.draft("RGB", (int(image.size[0] * scale), int(image.size[1] * scale)))
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), reducing_gap=2.0)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.load()
+    decoded = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue(), decoded - started, time.perf_counter() - decoded
+
+
+async def prepare_image(data):
+    """Converts a downloaded photo to the JPEG sent to Gemini, off the event loop."""
+    submitted = time.perf_counter()
+    image_bytes, decode, encode = await asyncio.get_running_loop().run_in_executor(
+        get_image_executor(), _to_jpeg, data, conf.get("image_max_side"))
+    queued = max(time.perf_counter() - submitted - decode - encode, 0.0)
+    metrics.image_processing_seconds.observe(queued, stage="queue")
+    metrics.image_processing_seconds.observe(decode, stage="decode")
+    if image_bytes is None:
+        image_bytes = data
+        metrics.images_prepared.inc(result="passthrough")
+    else:
+        metrics.image_processing_seconds.observe(encode, stage="encode")
+        metrics.images_prepared.inc(result="converted")
+    metrics.image_bytes.inc(len(image_bytes), stage="sent")
+    return image_bytes
@@ -4,6 +4,7 @@ import sys
 import os
 import json
 import logging
+from urllib.parse import urlparse
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -12,24 +13,76 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
-import telebot
-from telebot.async_telebot import AsyncTeleBot
-import handlers
-import gemini
-from handlers import is_admin, load_authorized_users
-import config
-
 logger = logging.getLogger(__name__)
 
-async def main():
-    # --- Argument Parsing ---
+async def log_errors(coro, description):
+    try:
+        await coro
+    except Exception as e:
+        logger.error(f"{description}: {e}", exc_info=True)
+
+# Tasks running alongside the bot, referenced here since the event loop only keeps weak references
+background_tasks = set()
+
+def start_background_task(coro, description):
+    task = asyncio.create_task(log_errors(coro, description))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+def parse_args():
+    # Only argparse is needed here, so --help and --check-startup do not wait for the bot's imports
     parser = argparse.ArgumentParser(description="Gemini Telegram Bot")
-    parser.add_argument("tg_token", help="Telegram Bot token")
-    parser.add_argument("gemini_key", help="Google Gemini API key(s), comma-separated")
-    parser.add_argument("--admin-uid", type=int, nargs='+', required=True, help="Space-separated list of administrator User IDs")
+    parser.add_argument("tg_token", nargs='?', help="Telegram Bot token")
+    parser.add_argument("gemini_key", nargs='?', help="Google Gemini API key(s), comma-separated")
+    parser.add_argument("--admin-uid", type=int, nargs='+', help="Space-separated list of administrator User IDs")
+    parser.add_argument("--webhook", action="store_true", help="Receive updates through a webhook instead of long polling")
+    parser.add_argument("--webhook-url", help="Public HTTPS URL Telegram sends updates to (required with --webhook)")
+    parser.add_argument("--webhook-listen", default="0.0.0.0", help="Address the webhook server listens on")
+    parser.add_argument("--webhook-port", type=int, default=8443, help="Port the webhook server listens on")
+    parser.add_argument("--webhook-path", help="Path the webhook server serves (default: the path of --webhook-url)")
+    parser.add_argument("--webhook-secret", help="Secret token Telegram sends with each update (random if not set)")
+    parser.add_argument("--webhook-cert", help="Certificate to serve TLS with and upload to Telegram (e.g. self-signed)")
+    parser.add_argument("--webhook-key", help="Private key of --webhook-cert")
+    parser.add_argument("--max-concurrent-updates", type=int, help="Updates processed at the same time in webhook mode")
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes; updates are sharded between them by user ID (default: conf workers)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics at /metrics on this port; with --workers, worker i uses port + i (default: conf metrics_port)")
+    parser.add_argument("--check-startup", action="store_true",
+                        help="Report the import time of startup and exit nonzero if it exceeds the budget")
+    parser.add_argument("--startup-budget-ms", type=float,
+                        help="Import time budget of --check-startup (default: conf startup_import_budget_ms)")
     options = parser.parse_args()
+    if options.check_startup:
+        return options
+    if not options.tg_token or not options.gemini_key:
+        parser.error("the following arguments are required: tg_token, gemini_key")
+    if not options.admin_uid:
+        parser.error("the following arguments are required: --admin-uid")
+    if options.webhook and not options.webhook_url:
+        parser.error("--webhook requires --webhook-url")
+    return options
+
+async def main(options):
+    # Heavy modules are imported once the arguments are known, and mode-specific ones only when used
+    from telebot.async_telebot import AsyncTeleBot
+    import handlers
+    import gemini
+    import images
+    from handlers import is_admin, load_authorized_users
+    import config
 
     # --- Initialization ---
+    if options.workers is None:
+        options.workers = config.conf.get("workers", 1)
+    if options.metrics_port is None:
+        options.metrics_port = config.conf.get("metrics_port", 0)
     config.ADMIN_UID = options.admin_uid
 
     # Populate API keys from command-line argument
@@ -43,6 +96,7 @@ async def main():
 
     # Initialize the Gemini client within the running async loop
     await gemini.initialize_client()
+    gemini.open_history_store()
 
     # Initialize user data file
     if not os.path.exists(config.USER_DATA_FILE):
@@ -54,24 +108,73 @@ async def main():
     bot = AsyncTeleBot(options.tg_token)
     handlers.register_handlers(bot) # Register all handlers from the handlers module
 
-    # Set bot commands for users
+    # Set bot commands for users whose menu changed since it was last set
     authorized_users = load_authorized_users()
-    for user_id in authorized_users:
-        try:
-            menu = handlers.admin_menu_zh if is_admin(user_id) else handlers.user_menu_zh
-            await bot.set_my_commands(menu, scope=telebot.types.BotCommandScopeChat(user_id))
-        except Exception as e:
-            logger.error(f"Failed to set commands for user {user_id}: {e}")
-    
-    await bot.set_my_commands(handlers.user_menu_zh, scope=telebot.types.BotCommandScopeDefault())
+    menus = {user_id: handlers.admin_menu_zh if is_admin(user_id) else handlers.user_menu_zh for user_id in authorized_users}
+    menu_sync = handlers.menu_registry.sync(bot, menus, default_menu=handlers.user_menu_zh)
+    if config.conf.get("menu_registration_background"):
+        # Serve updates right away; menus of users appear as they are set
+        start_background_task(menu_sync, "Menu registration failed")
+    else:
+        await menu_sync
 
     logger.info("Bot init done.")
-    logger.info("Starting Gemini_Telegram_Bot polling.")
-    await bot.polling(none_stop=True)
+    workers = None
+    metrics_runner = None
+    try:
+        if options.metrics_port and options.workers <= 1:
+            import metrics
+            metrics_runner = await metrics.start_metrics_server(options.metrics_port)
+        if options.workers > 1:
+            from supervisor import Supervisor
+            from state_store import SharedState
+            # Workers start from the keys given on the command line
+            state = SharedState(config.conf["shared_state_path"])
+            state.set_api_keys(gemini.api_keys)
+            state.clear_cooldowns()
+            state.close()
+            workers = Supervisor(options.workers, options.tg_token, config.ADMIN_UID, config.conf["shared_state_path"],
+                                 metrics_port=options.metrics_port)
+            workers.start()
+            start_background_task(workers.watch(), "Watching the workers failed")
+        if options.webhook:
+            import webhook
+            logger.info("Starting Gemini_Telegram_Bot webhook.")
+            server = webhook.WebhookServer(
+                bot,
+                path=options.webhook_path or urlparse(options.webhook_url).path or "/",
+                secret_token=options.webhook_secret,
+                max_concurrent_updates=options.max_concurrent_updates,
+                dispatch=workers.dispatch if workers else None,
+            )
+            await server.run(options.webhook_url, options.webhook_listen, options.webhook_port,
+                             certificate=options.webhook_cert, private_key=options.webhook_key)
+        else:
+            logger.info("Starting Gemini_Telegram_Bot polling.")
+            # Polling does not work while a webhook is set
+            await bot.remove_webhook()
+            if workers:
+                await workers.poll()
+            else:
+                await bot.polling(none_stop=True)
+    finally:
+        await stop_background_tasks()
+        if workers:
+            workers.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await gemini.close_client_pool()
+        gemini.session_store.close()
+        images.shutdown_image_pool()
 
 if __name__ == '__main__':
+    options = parse_args()
+    if options.check_startup:
+        import startup
+        from config import conf
+        sys.exit(startup.check_startup(options.startup_budget_ms or conf.get("startup_import_budget_ms", 2500)))
     try:
-        asyncio.run(main())
+        asyncio.run(main(options))
     except KeyboardInterrupt:
         logger.info("Bot stopped manually.")
     except Exception as e:
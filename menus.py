@@ -0,0 +1,101 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import telebot
+from config import conf
+from streaming import get_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+def menu_hash(menu):
+    commands = [(command.command, command.description) for command in menu]
+    return hashlib.sha256(json.dumps(commands, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class MenuRegistry:
+    """
+    Sets command menus and remembers a hash of the last menu set per chat in a
+    local JSON file, so that unchanged menus are not sent to Telegram again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._hashes = self._load()
+        self._changed = {}
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Failed to load menu state from {self.path}: {e}")
+            return {}
+
+    def save(self):
+        """Writes the hashes changed since the last save, keeping those written by other processes."""
+        if not self._changed:
+            return
+        hashes = self._load()
+        hashes.update(self._changed)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Failed to save menu state to {self.path}: {e}")
+            return
+        self._hashes = hashes
+        self._changed = {}
+
+    def is_current(self, key, menu):
+        return self._hashes.get(str(key)) == menu_hash(menu)
+
+    async def set_menu(self, bot, menu, chat_id=None, save=True):
+        """Sets `menu` for `chat_id`, or as the default menu without one, and records it."""
+        scope = telebot.types.BotCommandScopeChat(chat_id) if chat_id is not None else telebot.types.BotCommandScopeDefault()
+        key = str(chat_id) if chat_id is not None else "default"
+        for attempt in range(3):
+            try:
+                await bot.set_my_commands(menu, scope=scope)
+                break
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or attempt == 2:
+                    raise
+                logger.warning(f"Rate limited setting the menu of {key}, retrying in {retry_after}s.")
+                await asyncio.sleep(retry_after)
+        self._hashes[key] = self._changed[key] = menu_hash(menu)
+        if save:
+            self.save()
+
+    async def sync(self, bot, menus, default_menu=None, concurrency=None):
+        """
+        Sets the menus of {chat_id: menu} that differ from the ones last set, at most
+        `concurrency` at a time, then the default menu.
+        """
+        semaphore = asyncio.Semaphore(concurrency or conf.get("menu_registration_concurrency", 8))
+        pending = {chat_id: menu for chat_id, menu in menus.items() if not self.is_current(chat_id, menu)}
+        failed = 0
+
+        async def set_one(chat_id, menu):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    await self.set_menu(bot, menu, chat_id, save=False)
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Failed to set commands for user {chat_id}: {e}")
+
+        try:
+            await asyncio.gather(*(set_one(chat_id, menu) for chat_id, menu in pending.items()))
+            if default_menu is not None and not self.is_current("default", default_menu):
+                await self.set_menu(bot, default_menu, save=False)
+        finally:
+            self.save()
+        logger.info(f"Menus: {len(pending) - failed} set, {len(menus) - len(pending)} unchanged, {failed} failed.")
@@ -0,0 +1,180 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120)
+CHUNK_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+IMAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, values, extra, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for values, value in self._values.items():
+            yield "_total", values, (), value
+
+
+class Gauge(_Metric):
+    """A gauge read when scraped from `function`, which returns {label values tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        if self.function is None:
+            return
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.error(f"Failed to read gauge {self.name}: {e}")
+            return
+        for key, value in values.items():
+            yield "", key, (), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def _samples(self):
+        for values, (counts, count, total) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield "_bucket", values, (("le", _format_value(bound)),), bucket_count
+            yield "_bucket", values, (("le", "+Inf"),), count
+            yield "_count", values, (), count
+            yield "_sum", values, (), total
+
+
+# --- Metrics of the bot ---
+
+registry = []
+
+
+def _register(metric):
+    registry.append(metric)
+    return metric
+
+
+time_to_first_token = _register(Histogram(
+    "gemini_time_to_first_token_seconds", "Time from receiving a prompt to the first streamed chunk.", ["model"]))
+generation_seconds = _register(Histogram(
+    "gemini_generation_seconds", "Time from receiving a prompt to the finished answer.", ["model"]))
+response_chunks = _register(Histogram(
+    "gemini_response_chunks", "Streamed chunks per answer.", ["model"], buckets=CHUNK_BUCKETS))
+rate_limited = _register(Counter(
+    "gemini_rate_limited", "Rate limit (429) errors per API key.", ["key"]))
+key_failovers = _register(Counter(
+    "gemini_key_failovers", "Requests moved to another API key after an error.", ["model"]))
+key_switches = _register(Counter(
+    "gemini_default_key_switches", "Switches of the default API key (switch_to_next_api_key)."))
+telegram_edits = _register(Counter(
+    "telegram_edit_calls", "editMessageText calls made for answers and their status messages."))
+telegram_edit_failures = _register(Counter(
+    "telegram_edit_failures", "Failed editMessageText calls by reason.", ["reason"]))
+active_sessions = _register(Gauge(
+    "bot_active_sessions", "Chat sessions held in memory per session dict.", ["session"]))
+cache_requests = _register(Counter(
+    "bot_cache_requests", "Lookups in the result caches by result (hit or miss).", ["cache", "result"]))
+cache_entries = _register(Gauge(
+    "bot_cache_entries", "Entries held per result cache.", ["cache"]))
+image_download_seconds = _register(Histogram(
+    "bot_image_download_seconds", "Time to download a photo from Telegram.", buckets=IMAGE_BUCKETS))
+image_processing_seconds = _register(Histogram(
+    "bot_image_processing_seconds", "Time per photo waiting for the image pool (queue), decoding and scaling (decode) and encoding (encode).",
+    ["stage"], buckets=IMAGE_BUCKETS))
+image_bytes = _register(Counter(
+    "bot_image_bytes", "Bytes of photos downloaded from Telegram (downloaded) and sent to the model (sent).", ["stage"]))
+images_prepared = _register(Counter(
+    "bot_images_prepared", "Photos prepared for the model, sent as downloaded (passthrough) or re-encoded (converted).", ["result"]))
+generations = _register(Gauge(
+    "bot_generations", "Generations running (active), waiting for a slot (waiting) or behind the same user's (queued).", ["state"]))
+
+
+def key_label(key):
+    """Identifies an API key in metrics without exposing it."""
+    return f"...{key[-4:]}"
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def start_metrics_server(port, listen="0.0.0.0"):
+    """Serves the metrics in the Prometheus text format at /metrics. Returns the runner to clean up."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info(f"Metrics served on {listen}:{port}/metrics")
+    return runner
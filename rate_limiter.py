@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough token estimate used before a request is sent; corrected afterwards from usage_metadata
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class TokenBucket:
+    """A bucket refilled continuously at `capacity` tokens per `period` seconds (a minute by default)."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.refill_rate = self.capacity / period
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+            self.updated_at = now
+
+    def wait_time(self, amount, now=None):
+        """Seconds until `amount` tokens are available (0 if they are available now)."""
+        now = now or time.monotonic()
+        self._refill(now)
+        # A request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_rate
+
+    def consume(self, amount, now=None):
+        self._refill(now or time.monotonic())
+        # May go negative when actual usage exceeds the estimate; the debt is repaid by refill
+        self.tokens -= amount
+
+
+def _key_id(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class RateLimiter:
+    """
+    Client-side RPM/TPM buckets per (API key, model).
+    Limits come from conf["rate_limits"][tier][model_key], where the tier of a key
+    is "paid" or "free" and model_key is a conf key such as "model_1". Keys whose
+    tier is not known yet use conf["rate_limit_default_tier"], unthrottled if unset.
+
+    Tiers found by /api_check are kept in conf["key_tiers_path"] (by key hash) and
+    apply again after a restart.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.key_tiers = {}
+        self._saved_tiers = None
+        # Tiers set since the last save_tiers(), by key hash
+        self._unsaved_tiers = {}
+        self._save_lock = asyncio.Lock()
+        self._buckets = {}
+
+    def _load_tiers(self):
+        path = self.conf.get("key_tiers_path")
+        if not path:
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Failed to load key tiers from {path}: {e}")
+            return {}
+
+    def _write_tiers_file(self, path, changes):
+        # Merge with the file, which other worker processes may have written meanwhile,
+        # and atomically replace it so readers never see a partial file
+        tiers = self._load_tiers()
+        tiers.update(changes)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(tiers, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return tiers
+
+    async def save_tiers(self):
+        """Writes the tiers set since the last save to conf["key_tiers_path"], off the event loop."""
+        path = self.conf.get("key_tiers_path")
+        if not path:
+            return
+        async with self._save_lock:
+            changes, self._unsaved_tiers = self._unsaved_tiers, {}
+            if not changes:
+                return
+            try:
+                self._saved_tiers = await asyncio.to_thread(self._write_tiers_file, path, changes)
+            except Exception as e:
+                logger.error(f"Failed to save key tiers to {path}: {e}")
+                self._unsaved_tiers = {**changes, **self._unsaved_tiers}
+
+    def get_key_tier(self, key):
+        tier = self.key_tiers.get(key)
+        if tier is None:
+            if self._saved_tiers is None:
+                self._saved_tiers = self._load_tiers()
+            tier = self._saved_tiers.get(_key_id(key))
+            if tier is not None:
+                self.key_tiers[key] = tier
+        return tier or self.conf.get("rate_limit_default_tier")
+
+    def set_key_tier(self, key, tier, save=True):
+        """Sets the tier of a key; with `save`, it is written on the next save_tiers()."""
+        if self.key_tiers.get(key) != tier:
+            self.key_tiers[key] = tier
+            if save:
+                self._unsaved_tiers[_key_id(key)] = tier
+            # Limits changed, start the buckets of this key afresh
+            for bucket_id in [b for b in self._buckets if b[0] == key]:
+                del self._buckets[bucket_id]
+
+    def forget_key(self, key):
+        # The saved tier stays, it still applies if the key is added again
+        self.key_tiers.pop(key, None)
+        for bucket_id in [b for b in self._buckets if b[0] == key]:
+            del self._buckets[bucket_id]
+
+    def _get_limits(self, key, model_name):
+        tier = self.get_key_tier(key)
+        if tier is None:
+            return None
+        tier_limits = self.conf.get("rate_limits", {}).get(tier, {})
+        for model_key, limits in tier_limits.items():
+            if self.conf.get(model_key) == model_name:
+                return limits
+        return None
+
+    def _get_buckets(self, key, model_name):
+        bucket_id = (key, model_name)
+        buckets = self._buckets.get(bucket_id)
+        if buckets is None:
+            limits = self._get_limits(key, model_name)
+            if not limits:
+                return None
+            buckets = (
+                TokenBucket(limits["rpm"]) if limits.get("rpm") else None,
+                TokenBucket(limits["tpm"]) if limits.get("tpm") else None,
+            )
+            self._buckets[bucket_id] = buckets
+        return buckets
+
+    def wait_time(self, key, model_name, tokens=0):
+        """Seconds until a request of `tokens` tokens fits the key's budget for the model."""
+        if not model_name:
+            return 0.0
+        buckets = self._get_buckets(key, model_name)
+        if buckets is None:
+            return 0.0
+        now = time.monotonic()
+        rpm_bucket, tpm_bucket = buckets
+        wait = rpm_bucket.wait_time(1, now) if rpm_bucket else 0.0
+        if tpm_bucket and tokens:
+            wait = max(wait, tpm_bucket.wait_time(tokens, now))
+        return wait
+
+    def consume(self, key, model_name, tokens=0):
+        if not model_name:
+            return
+        buckets = self._get_buckets(key, model_name)
+        if buckets is None:
+            return
+        now = time.monotonic()
+        rpm_bucket, tpm_bucket = buckets
+        if rpm_bucket:
+            rpm_bucket.consume(1, now)
+        if tpm_bucket and tokens:
+            tpm_bucket.consume(tokens, now)
+
+    def record_usage(self, key, model_name, actual_tokens, estimated_tokens):
+        """Corrects the TPM bucket once the real token count of a request is known."""
+        if not model_name or actual_tokens is None:
+            return
+        buckets = self._get_buckets(key, model_name)
+        if buckets is None or buckets[1] is None:
+            return
+        buckets[1].consume(actual_tokens - estimated_tokens)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager, AsyncExitStack
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLimiter:
+    """
+    Orders and bounds model generations.
+
+    - Per user and session, generations run one at a time in arrival order, so
+      messages sent in quick succession do not use the same chat concurrently.
+    - Globally, at most conf["max_concurrent_generations"] run at the same time.
+    - At most conf["max_waiting_generations"] more may wait for a global slot; past
+      that is_busy() is true and new requests should be turned away.
+    - A user may have at most conf["max_queued_per_user"] generations waiting, in all
+      sessions together; past that is_user_busy() is true for them. Requests queued
+      behind the user's own earlier ones do not count towards the global wait queue,
+      so one user's burst cannot make the bot busy for everyone else.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._semaphore = None
+        self._user_locks = {}
+        # Generations not running yet per user, queued or waiting
+        self._user_pending = {}
+        self.active = 0
+        # Waiting for a global slot
+        self.waiting = 0
+        # Waiting for an earlier generation of the same user and session
+        self.queued = 0
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.conf.get("max_concurrent_generations", 32))
+        return self._semaphore
+
+    def is_busy(self):
+        capacity = self.conf.get("max_concurrent_generations", 32) + self.conf.get("max_waiting_generations", 64)
+        return self.active + self.waiting >= capacity
+
+    def is_user_busy(self, user_id):
+        max_queued = self.conf.get("max_queued_per_user", 2)
+        return bool(max_queued) and self._user_pending.get(str(user_id), 0) >= max_queued
+
+    def _enter_queue(self, user_id, session):
+        key = (str(user_id), session)
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return key, entry
+
+    def _leave_queue(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._user_locks[key]
+
+    def _set_pending(self, user, change):
+        count = self._user_pending.get(user, 0) + change
+        if count:
+            self._user_pending[user] = count
+        else:
+            del self._user_pending[user]
+
+    @asynccontextmanager
+    async def slot(self, user_id, session):
+        """Waits for the user's earlier generations in `session` and for a global slot."""
+        key, entry = self._enter_queue(user_id, session)
+        self._set_pending(key[0], 1)
+        self.queued += 1
+        state = "queued"
+        try:
+            async with entry[0]:
+                self.queued -= 1
+                self.waiting += 1
+                state = "waiting"
+                async with self._get_semaphore():
+                    self.waiting -= 1
+                    self._set_pending(key[0], -1)
+                    state = "active"
+                    self.active += 1
+                    try:
+                        yield
+                    finally:
+                        self.active -= 1
+        finally:
+            if state == "queued":
+                self.queued -= 1
+            elif state == "waiting":
+                self.waiting -= 1
+            if state != "active":
+                self._set_pending(key[0], -1)
+            self._leave_queue(key, entry)
+
+    @asynccontextmanager
+    async def user_lock(self, user_id, sessions):
+        """
+        Waits for the user's earlier generations in each of `sessions` and keeps new
+        ones out, without taking a global slot; for commands that replace or clear chats.
+        """
+        async with AsyncExitStack() as stack:
+            for session in sorted(sessions):
+                key, entry = self._enter_queue(user_id, session)
+                stack.callback(self._leave_queue, key, entry)
+                await stack.enter_async_context(entry[0])
+            yield
+
+
+class _Burst:
+    def __init__(self, message):
+        self.messages = [message]
+        self.arrived = asyncio.Event()
+
+
+class MessageCoalescer:
+    """
+    Merges bursts of messages of one user, such as a long paste that Telegram
+    split into several messages, so that they are answered together.
+    """
+
+    def __init__(self):
+        self._bursts = {}
+
+    async def collect(self, key, message, window):
+        """
+        Waits until no further message for `key` arrives within `window` seconds.
+        Returns all messages of the burst to the call that started it, and None to
+        the calls whose message was added to a running burst.
+        """
+        burst = self._bursts.get(key)
+        if burst is not None:
+            burst.messages.append(message)
+            burst.arrived.set()
+            return None
+        burst = self._bursts[key] = _Burst(message)
+        try:
+            while True:
+                burst.arrived.clear()
+                try:
+                    await asyncio.wait_for(burst.arrived.wait(), window)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            del self._bursts[key]
+        return burst.messages
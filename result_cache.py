@@ -0,0 +1,46 @@
+import time
+import logging
+from collections import OrderedDict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    A bounded LRU cache for model results, with an optional TTL (seconds).
+    Its hits and misses are counted in metrics.cache_requests, labeled with `name`.
+    """
+
+    def __init__(self, name, max_entries, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            metrics.cache_requests.inc(cache=self.name, result="miss")
+            return None
+        metrics.cache_requests.inc(cache=self.name, result="hit")
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        self._entries[key] = (value, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return None if entry is None else entry[0]
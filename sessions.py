@@ -0,0 +1,251 @@
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_history_bytes(chat):
+    """Approximate memory held by a chat's history (text and inline data)."""
+    if not hasattr(chat, 'get_history'):
+        return 0
+    total = 0
+    try:
+        history = chat.get_history()
+    except Exception:
+        return 0
+    for content in history:
+        for part in getattr(content, 'parts', None) or []:
+            if getattr(part, 'text', None):
+                total += len(part.text.encode('utf-8'))
+            inline_data = getattr(part, 'inline_data', None)
+            if inline_data is not None and getattr(inline_data, 'data', None):
+                total += len(inline_data.data)
+    return total
+
+
+class SessionStore:
+    """
+    Holds every user's chat sessions, across all chat types, in one LRU order.
+    Only active sessions are kept in memory; with a history store, histories
+    are also written to disk after each turn and read back on demand.
+
+    Sessions idle for longer than conf["session_idle_ttl"] seconds are dropped,
+    and the least recently used sessions are evicted once there are more than
+    conf["session_max_count"] sessions or their histories take more than
+    conf["session_max_history_bytes"] bytes.
+    """
+
+    def __init__(self, conf, history_store=None):
+        self.conf = conf
+        # Optional on-disk copy of the histories (history_store.HistoryStore), so
+        # evicted or lost sessions can be rebuilt on the user's next message
+        self.history_store = history_store
+        # Called with (namespace, user_id) when a session is evicted or deleted,
+        # to release state kept for it elsewhere
+        self.on_drop = None
+        # (namespace, user_id) -> [chat, last_used, history_bytes]
+        self._sessions = OrderedDict()
+        self._total_bytes = 0
+        self._namespaces = {}
+
+    def namespace(self, name):
+        if name not in self._namespaces:
+            self._namespaces[name] = SessionNamespace(self, name)
+        return self._namespaces[name]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def count(self, namespace):
+        return sum(1 for ns, _ in self._sessions if ns == namespace)
+
+    def _is_expired(self, entry, now):
+        ttl = self.conf.get("session_idle_ttl")
+        return bool(ttl) and now - entry[1] > ttl
+
+    def _dropped(self, session_id):
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(*session_id)
+        except Exception as e:
+            logger.error(f"Failed to release session {session_id[0]}/{session_id[1]}: {e}")
+
+    def _drop(self, session_id, reason):
+        entry = self._sessions.pop(session_id)
+        self._total_bytes -= entry[2]
+        logger.info(f"Session {session_id[0]}/{session_id[1]} evicted ({reason}).")
+        self._dropped(session_id)
+
+    def _evict(self, keep=None):
+        now = time.time()
+        # Idle sessions are at the front of the LRU order
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if session_id == keep or not self._is_expired(entry, now):
+                break
+            self._drop(session_id, "idle")
+        max_count = self.conf.get("session_max_count")
+        max_bytes = self.conf.get("session_max_history_bytes")
+        while self._sessions:
+            over_count = max_count and len(self._sessions) > max_count
+            over_bytes = max_bytes and self._total_bytes > max_bytes
+            if not over_count and not over_bytes:
+                break
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                if len(self._sessions) == 1:
+                    break
+                self._sessions.move_to_end(session_id)
+                session_id = next(iter(self._sessions))
+            self._drop(session_id, "limit")
+
+    def get(self, namespace, user_id):
+        session_id = (namespace, str(user_id))
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        now = time.time()
+        if self._is_expired(entry, now):
+            self._drop(session_id, "idle")
+            return None
+        entry[1] = now
+        self._sessions.move_to_end(session_id)
+        return entry[0]
+
+    def set(self, namespace, user_id, chat):
+        session_id = (namespace, str(user_id))
+        old = self._sessions.pop(session_id, None)
+        if old is not None:
+            self._total_bytes -= old[2]
+        size = estimate_history_bytes(chat)
+        self._sessions[session_id] = [chat, time.time(), size]
+        self._total_bytes += size
+        self._evict(keep=session_id)
+
+    def touch(self, namespace, user_id):
+        """Marks a session as used and re-measures its history after a turn."""
+        session_id = (namespace, str(user_id))
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return
+        size = estimate_history_bytes(entry[0])
+        self._total_bytes += size - entry[2]
+        entry[1] = time.time()
+        entry[2] = size
+        self._sessions.move_to_end(session_id)
+        self._evict(keep=session_id)
+
+    def delete(self, namespace, user_id):
+        session_id = (namespace, str(user_id))
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self._total_bytes -= entry[2]
+        self._dropped(session_id)
+        return True
+
+    async def restore(self, namespace, user_id):
+        """
+        Returns (chat, history) for a user's session. The chat is None when the
+        session is not in memory; its history is then read from the history store.
+        """
+        chat = self.get(namespace, user_id)
+        if chat is not None:
+            return chat, list(chat.get_history(curated=True))
+        if self.history_store is None:
+            return None, []
+        try:
+            history = await self.history_store.load_async(namespace, user_id)
+        except Exception as e:
+            logger.error(f"Failed to load history of user {user_id}: {e}")
+            return None, []
+        if history:
+            logger.info(f"Restored {len(history)} messages of session {namespace}/{user_id} from disk.")
+        return None, history
+
+    async def persist(self, namespace, user_id, chat, rewrite=False):
+        """
+        Records a finished turn of `chat`: re-measures the session, putting it back if it
+        was evicted during the turn, and writes its new messages to disk.
+        """
+        if self._sessions.get((namespace, str(user_id))) is None:
+            self.set(namespace, user_id, chat)
+        else:
+            self.touch(namespace, user_id)
+        if self.history_store is None:
+            return
+        try:
+            await self.history_store.save_async(namespace, user_id, list(chat.get_history(curated=True)), rewrite)
+        except Exception as e:
+            logger.error(f"Failed to save history of user {user_id}: {e}")
+
+    async def clear_user(self, user_id):
+        """Drops all sessions of a user, in every namespace, from memory and disk."""
+        user_id = str(user_id)
+        for session_id in [sid for sid in self._sessions if sid[1] == user_id]:
+            self.delete(*session_id)
+        if self.history_store is not None:
+            try:
+                await self.history_store.delete_async(user_id)
+            except Exception as e:
+                logger.error(f"Failed to delete history of user {user_id}: {e}")
+
+    def close(self):
+        if self.history_store is not None:
+            self.history_store.close()
+
+
+class SessionNamespace:
+    """Dict-like view of one chat type in a SessionStore, keyed by user ID."""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get(self, user_id, default=None):
+        chat = self.store.get(self.name, user_id)
+        return default if chat is None else chat
+
+    def touch(self, user_id):
+        self.store.touch(self.name, user_id)
+
+    async def restore(self, user_id):
+        return await self.store.restore(self.name, user_id)
+
+    async def persist(self, user_id, chat, rewrite=False):
+        await self.store.persist(self.name, user_id, chat, rewrite)
+
+    def __contains__(self, user_id):
+        return self.store.get(self.name, user_id) is not None
+
+    def __getitem__(self, user_id):
+        chat = self.store.get(self.name, user_id)
+        if chat is None:
+            raise KeyError(user_id)
+        return chat
+
+    def __setitem__(self, user_id, chat):
+        self.store.set(self.name, user_id, chat)
+
+    def __delitem__(self, user_id):
+        if not self.store.delete(self.name, user_id):
+            raise KeyError(user_id)
+
+    def pop(self, user_id, default=None):
+        chat = self.store.get(self.name, user_id)
+        if chat is None:
+            return default
+        self.store.delete(self.name, user_id)
+        return chat
+
+    def items(self):
+        return [(user_id, entry[0]) for (ns, user_id), entry in self.store._sessions.items() if ns == self.name]
+
+    def __len__(self):
+        return self.store.count(self.name)
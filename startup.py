@@ -0,0 +1,61 @@
+import os
+import sys
+import subprocess
+
+# Modules the bot imports before it can serve its first update
+STARTUP_MODULES = ("main", "handlers", "gemini")
+
+
+def measure_imports(modules=STARTUP_MODULES):
+    """
+    Imports `modules` in a fresh interpreter with -X importtime.
+    Returns (total seconds, [(module, cumulative seconds, depth)] in import order).
+    """
+    code = (
+        "import time; started = time.perf_counter()\n"
+        f"for name in {list(modules)!r}: __import__(name)\n"
+        "print(time.perf_counter() - started)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(cumulative) / 1e6, depth))
+    return float(result.stdout.strip().splitlines()[-1]), imports
+
+
+def check_startup(budget_ms, top=15):
+    """
+    Prints the import time of the bot's startup, its slowest third-party imports
+    and the bot's own modules. Returns 1 when it exceeds `budget_ms`, else 0.
+    """
+    total, imports = measure_imports()
+    local_modules = {name[:-3] for name in os.listdir(os.path.dirname(os.path.abspath(__file__))) if name.endswith(".py")}
+    # -X importtime lists a module after the modules it imported, one level deeper
+    third_party = []
+    importers = {}
+    for name, seconds, depth in reversed(imports):
+        importers[depth] = name
+        if depth and importers.get(depth - 1) in local_modules and name not in local_modules:
+            third_party.append((name, seconds))
+    third_party.sort(key=lambda entry: entry[1], reverse=True)
+
+    print("Slowest third-party modules imported by the bot (cumulative):")
+    for name, seconds in third_party[:top]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+    print("Bot modules (cumulative, including what they import first):")
+    for name, seconds, _ in imports:
+        if name in local_modules:
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+    print(f"Total startup import time: {total * 1000:.1f} ms (budget {budget_ms} ms)")
+    if total * 1000 > budget_ms:
+        print("Startup import time is over budget.")
+        return 1
+    return 0
@@ -0,0 +1,65 @@
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+    """
+    State shared by the worker processes of a sharded bot, in a local SQLite file:
+    the list of API keys, their cooldowns and tiers. Every worker writes its changes
+    through and reads the others' with load().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS api_keys (position INTEGER PRIMARY KEY, key TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cooldowns (key TEXT PRIMARY KEY, until REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS key_tiers (key TEXT PRIMARY KEY, tier TEXT NOT NULL)")
+        self._conn.commit()
+
+    def set_api_keys(self, keys):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM api_keys")
+            self._conn.executemany("INSERT INTO api_keys (position, key) VALUES (?, ?)", list(enumerate(keys)))
+            self._conn.execute("DELETE FROM cooldowns WHERE key NOT IN (SELECT key FROM api_keys)")
+            self._conn.execute("DELETE FROM key_tiers WHERE key NOT IN (SELECT key FROM api_keys)")
+
+    def set_cooldown(self, key, until):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO cooldowns (key, until) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET until = MAX(until, excluded.until)",
+                (key, until),
+            )
+
+    def set_key_tier(self, key, tier):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO key_tiers (key, tier) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET tier = excluded.tier",
+                (key, tier),
+            )
+
+    def clear_cooldowns(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cooldowns")
+
+    def load(self):
+        """
+        Returns (API keys in order, {key: cooldown end} for keys still cooling down,
+        {key: tier} for keys /api_check has classified).
+        """
+        with self._lock:
+            keys = [row[0] for row in self._conn.execute("SELECT key FROM api_keys ORDER BY position")]
+            cooldowns = dict(self._conn.execute("SELECT key, until FROM cooldowns WHERE until > ?", (time.time(),)))
+            tiers = dict(self._conn.execute("SELECT key, tier FROM key_tiers"))
+        return keys, cooldowns, tiers
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,435 @@
+import re
+import time
+import asyncio
+import logging
+from md2tgmd import escape
+from rate_limiter import TokenBucket
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Tokens that change whether a paragraph break is a safe place to cut the text:
+# code fences and display math blocks may contain blank lines.
+_BLOCK_TOKEN_RE = re.compile(r"```|\\\[|\\\]|\n\n+")
+
+
+def escape_segment(segment):
+    """
+    Escapes one paragraph-aligned segment to MarkdownV2.
+    The segment is escaped with a paragraph break in front of it, so that rules
+    anchored on preceding newlines (lists, quotes, code blocks) behave as they
+    do inside the full text.
+    """
+    escaped = escape("\n\n" + segment)
+    if escaped.startswith("\n\n"):
+        escaped = escaped[2:]
+    return escaped
+
+
+def find_stable_boundary(text):
+    """Returns the end of the last paragraph break in `text` that is outside code and math blocks (0 if none)."""
+    in_code = False
+    in_math = False
+    boundary = 0
+    for match in _BLOCK_TOKEN_RE.finditer(text):
+        token = match.group(0)
+        if token == "```":
+            if not in_math:
+                in_code = not in_code
+        elif token == "\\[":
+            if not in_code:
+                in_math = True
+        elif token == "\\]":
+            if not in_code:
+                in_math = False
+        elif not in_code and not in_math:
+            boundary = match.end()
+    return boundary
+
+
+def _close_open_fence(head):
+    """
+    Closes a code block left open at the end of `head`.
+    Returns the closed head and the fence line that reopens the block in the next page.
+    """
+    opener = None
+    for line in head.split("\n"):
+        for _ in range(line.count("```")):
+            opener = None if opener is not None else (line.strip() if line.strip().startswith("```") else "```")
+    if opener is None:
+        return head, ""
+    if not head.endswith("\n"):
+        head += "\n"
+    return head + "```", opener + "\n"
+
+
+def split_to_fit(text, limit):
+    """
+    Splits `text` into (head, rest) where the escaped head fits in `limit` characters.
+    Cuts at a line break when possible; a code block cut in two is closed in the
+    head and reopened at the start of the rest.
+    """
+    def fits(head):
+        return len(escape_segment(_close_open_fence(head)[0])) <= limit
+
+    lines = text.splitlines(keepends=True)
+    low, high = 0, len(lines)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits("".join(lines[:mid])):
+            low = mid
+        else:
+            high = mid - 1
+    if low:
+        head, rest = "".join(lines[:low]), "".join(lines[low:])
+    else:
+        # A single line longer than a page, cut it by characters
+        low, high = 1, len(lines[0])
+        while low < high:
+            mid = (low + high + 1) // 2
+            if fits(text[:mid]):
+                low = mid
+            else:
+                high = mid - 1
+        head, rest = text[:low], text[low:]
+    head, reopen = _close_open_fence(head)
+    return head, reopen + rest if rest else ""
+
+
+class StreamRenderer:
+    """
+    Incrementally renders a streamed response to Telegram MarkdownV2.
+
+    Chunks are buffered in a list. On render, only the part of the text after
+    the last escaped paragraph is looked at: completed paragraphs are escaped
+    once and cached, and only the still-open tail is escaped on every update.
+
+    With a `page_limit`, the response is split into pages whose MarkdownV2 stays
+    within the limit. Pages are cut at paragraph breaks, or at line breaks for a
+    single oversized paragraph. Only the last page is rendered; completed pages
+    are handed out once by update_pages().
+    """
+
+    def __init__(self, page_limit=None):
+        self.page_limit = page_limit
+        self._frozen_raw = []
+        self._completed_pages = []
+        self._stable_raw = []
+        self._stable_escaped = []
+        self._page_len = 0
+        self._pending = []
+
+    def append(self, text):
+        if text:
+            self._pending.append(text)
+
+    def _tail(self):
+        if len(self._pending) > 1:
+            self._pending = ["".join(self._pending)]
+        return self._pending[0] if self._pending else ""
+
+    def _close_page(self):
+        page = "".join(self._stable_raw)
+        self._frozen_raw.append(page)
+        self._completed_pages.append(page)
+        self._stable_raw, self._stable_escaped, self._page_len = [], [], 0
+
+    def _add_stable(self, raw):
+        escaped = escape_segment(raw)
+        if self.page_limit:
+            if self._stable_raw and self._page_len + len(escaped) > self.page_limit:
+                self._close_page()
+            while len(escaped) > self.page_limit:
+                head, raw = split_to_fit(raw, self.page_limit)
+                self._stable_raw.append(head)
+                self._close_page()
+                escaped = escape_segment(raw)
+        self._stable_raw.append(raw)
+        self._stable_escaped.append(escaped)
+        self._page_len += len(escaped)
+
+    def _advance(self):
+        tail = self._tail()
+        boundary = find_stable_boundary(tail)
+        if boundary:
+            stable, tail = tail[:boundary], tail[boundary:]
+            self._add_stable(stable)
+            self._pending = [tail] if tail else []
+        return tail
+
+    def update_pages(self):
+        """Moves overflowing text to new pages and returns the raw text of pages completed since the last call."""
+        tail = self._advance()
+        # The escaped tail is at least as long as the raw one, only escape it when it may overflow
+        if self.page_limit and tail and self._page_len + len(tail) > self.page_limit // 2:
+            escaped_tail = escape_segment(tail)
+            if self._page_len + len(escaped_tail) > self.page_limit:
+                if self._stable_raw:
+                    self._close_page()
+                while len(escaped_tail) > self.page_limit:
+                    head, tail = split_to_fit(tail, self.page_limit)
+                    self._stable_raw.append(head)
+                    self._close_page()
+                    escaped_tail = escape_segment(tail)
+                self._pending = [tail] if tail else []
+        pages, self._completed_pages = self._completed_pages, []
+        return pages
+
+    @property
+    def text(self):
+        """The raw text of the current page."""
+        return "".join(self._stable_raw) + self._tail()
+
+    @property
+    def full_text(self):
+        """The raw text of the whole response, across all pages."""
+        return "".join(self._frozen_raw) + self.text
+
+    @property
+    def pages(self):
+        """The raw text of every page of the response, the current one last."""
+        return self._frozen_raw + [self.text]
+
+    def render(self):
+        """MarkdownV2 of the current page for an intermediate update, reusing the escaped completed paragraphs."""
+        tail = self._advance()
+        escaped_tail = escape_segment(tail) if tail else ""
+        return "".join(self._stable_escaped) + escaped_tail
+
+    def final(self):
+        """MarkdownV2 of the current page once the response is finished, escaped as a whole."""
+        return escape(self.text)
+
+
+def get_retry_after(e):
+    """Returns Telegram's retry_after (seconds) for a 429 error, or None for other errors."""
+    result_json = getattr(e, "result_json", None)
+    if getattr(e, "error_code", None) == 429 and isinstance(result_json, dict):
+        retry_after = result_json.get("parameters", {}).get("retry_after")
+        if retry_after is not None:
+            return float(retry_after)
+    match = re.search(r"too many requests.*?retry after (\d+)", str(e), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def is_parse_error(e):
+    return "parse" in str(e).lower() or "entity" in str(e).lower()
+
+
+class _ChatEditState:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_edit_at = 0.0
+        self.blocked_until = 0.0
+        self.active_messages = 0
+        # edit_now/send_now calls in progress
+        self.direct_sends = 0
+        self.forget_scheduled = False
+
+
+class EditScheduler:
+    """
+    Schedules message edits for streamed responses within Telegram's flood limits.
+
+    - The first update of a stream is sent immediately (fast first paint).
+    - Later updates of the same chat are spaced by an interval that starts at
+      conf["streaming_update_interval"] and grows by conf["streaming_backoff_factor"]
+      after every edit, up to conf["streaming_max_update_interval"].
+    - Updates submitted while a message is waiting for its turn replace each other,
+      so only the latest text is sent.
+    - A 429 from Telegram blocks the chat for its retry_after and doubles the interval.
+    - All chats share a global budget of conf["telegram_global_edits_per_second"].
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._chats = {}
+        self._pending = {}
+        self._workers = {}
+        self._global_bucket = None
+
+    def _get_global_bucket(self):
+        if self._global_bucket is None:
+            rate = self.conf.get("telegram_global_edits_per_second", 25)
+            self._global_bucket = TokenBucket(rate, period=1.0)
+        return self._global_bucket
+
+    def _get_chat_state(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = _ChatEditState(self.conf.get("streaming_update_interval", 0.5))
+            self._chats[chat_id] = state
+        return state
+
+    async def _wait_turn(self, state, respect_interval=True):
+        bucket = self._get_global_bucket()
+        while True:
+            now = time.monotonic()
+            ready_at = state.blocked_until
+            if respect_interval:
+                ready_at = max(ready_at, state.next_edit_at)
+            wait = max(ready_at - now, bucket.wait_time(1, now))
+            if wait <= 0:
+                bucket.consume(1, now)
+                return
+            await asyncio.sleep(wait)
+
+    def _on_flood(self, state, e):
+        retry_after = get_retry_after(e)
+        if retry_after is None:
+            return False
+        state.blocked_until = time.monotonic() + retry_after
+        state.interval = min(state.interval * 2, self.conf.get("streaming_max_update_interval", 3))
+        logger.warning(f"Telegram flood limit hit, retrying after {retry_after}s.")
+        return True
+
+    def submit(self, bot, chat_id, message_id, render, fallback=None):
+        """
+        Queues an intermediate update. `render` returns the MarkdownV2 text and is only
+        called when the edit is actually sent; `fallback` returns plain text used if
+        Telegram rejects the markup.
+        """
+        key = (chat_id, message_id)
+        self._pending[key] = (bot, render, fallback)
+        if key not in self._workers:
+            state = self._get_chat_state(chat_id)
+            if state.active_messages == 0:
+                # A new stream in an idle chat starts at the base interval again
+                state.interval = self.conf.get("streaming_update_interval", 0.5)
+            state.active_messages += 1
+            self._workers[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        chat_id = key[0]
+        state = self._get_chat_state(chat_id)
+        try:
+            while key in self._pending:
+                await self._wait_turn(state)
+                item = self._pending.pop(key, None)
+                if item is None:
+                    break
+                await self._send_update(state, key, item)
+        finally:
+            self._release_worker(key, asyncio.current_task())
+
+    def _release_worker(self, key, task):
+        if self._workers.get(key) is task:
+            del self._workers[key]
+            self._get_chat_state(key[0]).active_messages -= 1
+            self._schedule_forget(key[0])
+
+    def _schedule_forget(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is not None and not state.forget_scheduled:
+            state.forget_scheduled = True
+            asyncio.get_running_loop().call_soon(self._forget_if_idle, chat_id)
+
+    def _forget_if_idle(self, chat_id):
+        """Drops the state of a chat once nothing is sent there and its flood block and interval have passed."""
+        state = self._chats.get(chat_id)
+        if state is None:
+            return
+        state.forget_scheduled = False
+        if state.active_messages or state.direct_sends:
+            return
+        delay = max(state.next_edit_at, state.blocked_until) - time.monotonic()
+        if delay > 0:
+            state.forget_scheduled = True
+            asyncio.get_running_loop().call_later(delay, self._forget_if_idle, chat_id)
+        else:
+            del self._chats[chat_id]
+
+    async def _edit(self, bot, **kwargs):
+        metrics.telegram_edits.inc()
+        try:
+            await bot.edit_message_text(**kwargs)
+        except Exception as e:
+            if get_retry_after(e) is not None:
+                reason = "flood"
+            elif "message is not modified" in str(e).lower():
+                reason = "not_modified"
+            elif is_parse_error(e):
+                reason = "parse"
+            else:
+                reason = "other"
+            metrics.telegram_edit_failures.inc(reason=reason)
+            raise
+
+    async def _send_update(self, state, key, item):
+        bot, render, fallback = item
+        chat_id, message_id = key
+        try:
+            try:
+                await self._edit(bot, text=render(), chat_id=chat_id, message_id=message_id, parse_mode="MarkdownV2")
+            except Exception as e:
+                if not is_parse_error(e) or fallback is None:
+                    raise
+                await self._edit(bot, text=fallback(), chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            if self._on_flood(state, e):
+                # Put the update back unless a newer one arrived meanwhile
+                self._pending.setdefault(key, item)
+            elif "message is not modified" not in str(e).lower():
+                logger.warning(f"Error updating message during stream: {e}")
+        now = time.monotonic()
+        state.next_edit_at = now + state.interval
+        state.interval = min(state.interval * self.conf.get("streaming_backoff_factor", 1.5),
+                             self.conf.get("streaming_max_update_interval", 3))
+
+    def cancel(self, chat_id, message_id):
+        """Drops any queued update for a message."""
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        task = self._workers.get(key)
+        if task is not None:
+            self._release_worker(key, task)
+            task.cancel()
+
+    async def edit_now(self, bot, text, chat_id, message_id, parse_mode=None):
+        """
+        Sends an edit that must not be dropped (final text, status and error messages).
+        Queued updates for the message are discarded; the chat's flood block and the
+        global budget are honored, and a 429 is retried after its retry_after.
+        """
+        self.cancel(chat_id, message_id)
+        state = self._get_chat_state(chat_id)
+        kwargs = {"text": text, "chat_id": chat_id, "message_id": message_id}
+        if parse_mode:
+            kwargs["parse_mode"] = parse_mode
+        attempts = self.conf.get("telegram_max_retries", 3)
+        state.direct_sends += 1
+        try:
+            for attempt in range(attempts):
+                await self._wait_turn(state, respect_interval=False)
+                try:
+                    await self._edit(bot, **kwargs)
+                    state.next_edit_at = time.monotonic() + state.interval
+                    return
+                except Exception as e:
+                    if attempt == attempts - 1 or not self._on_flood(state, e):
+                        raise
+        finally:
+            state.direct_sends -= 1
+            self._schedule_forget(chat_id)
+
+    async def send_now(self, bot, chat_id, text, **kwargs):
+        """
+        Sends a new message to a chat whose answer is streaming (e.g. the next page),
+        honoring the chat's flood block and retrying a 429 after its retry_after.
+        """
+        state = self._get_chat_state(chat_id)
+        attempts = self.conf.get("telegram_max_retries", 3)
+        state.direct_sends += 1
+        try:
+            for attempt in range(attempts):
+                await self._wait_turn(state, respect_interval=False)
+                try:
+                    return await bot.send_message(chat_id, text, **kwargs)
+                except Exception as e:
+                    if attempt == attempts - 1 or not self._on_flood(state, e):
+                        raise
+        finally:
+            state.direct_sends -= 1
+            self._schedule_forget(chat_id)
@@ -0,0 +1,165 @@
+import json
+import zlib
+import asyncio
+import logging
+import multiprocessing
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+import config
+from config import conf
+import gemini
+import handlers
+import images
+import metrics
+from state_store import SharedState
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_user_id(update):
+    """The ID of the user an update comes from (the chat's for updates without a sender), or 0."""
+    for name, value in update.items():
+        if name == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if not sender and isinstance(value.get("message"), dict):
+            sender = value["message"].get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+    return 0
+
+
+def get_worker_index(user_id, workers):
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def run_worker(index, workers, token, admin_uids, state_path, update_queue, metrics_port=None):
+    """Entry point of a worker process."""
+    try:
+        asyncio.run(_worker_main(index, workers, token, admin_uids, state_path, update_queue, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def _share_limits(workers):
+    """Splits the client-side budgets that are per process between the workers."""
+    for tier in conf.get("rate_limits", {}).values():
+        for limits in tier.values():
+            for name in ("rpm", "tpm"):
+                if limits.get(name):
+                    limits[name] = limits[name] / workers
+    conf["telegram_global_edits_per_second"] = conf.get("telegram_global_edits_per_second", 25) / workers
+
+
+async def _worker_main(index, workers, token, admin_uids, state_path, update_queue, metrics_port):
+    config.ADMIN_UID = admin_uids
+    _share_limits(workers)
+    gemini.shared_state = SharedState(state_path)
+    await gemini.sync_shared_state(force=True)
+    await gemini.initialize_client()
+    gemini.open_history_store()
+    # Each worker serves its own metrics, on consecutive ports
+    metrics_runner = await metrics.start_metrics_server(metrics_port + index) if metrics_port else None
+
+    bot = AsyncTeleBot(token)
+    handlers.register_handlers(bot)
+    logger.info(f"Worker {index} started.")
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while True:
+            raw_update = await loop.run_in_executor(None, update_queue.get)
+            if raw_update is None:
+                break
+            task = asyncio.create_task(bot.process_new_updates([Update.de_json(raw_update)]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await gemini.close_client_pool()
+        gemini.session_store.close()
+        gemini.shared_state.close()
+        images.shutdown_image_pool()
+        await bot.close_session()
+        logger.info(f"Worker {index} stopped.")
+
+
+class Supervisor:
+    """
+    Runs the bot in `workers` processes. Updates are received here and handed to
+    a worker chosen by hashing the sender's user ID, so each user's sessions live
+    in one worker. API keys, cooldowns and key tiers are shared through a SharedState file,
+    and the authorized users through the user file every worker already reloads.
+    With `metrics_port`, worker i serves its metrics on metrics_port + i.
+    """
+
+    def __init__(self, workers, token, admin_uids, state_path, metrics_port=None):
+        self.workers = workers
+        self.token = token
+        self.admin_uids = admin_uids
+        self.state_path = state_path
+        self.metrics_port = metrics_port
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._stopping = False
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.workers, self.token, self.admin_uids, self.state_path, self._queues[index], self.metrics_port),
+            name=f"worker-{index}",
+            # Not daemonic, so a worker may start the image process pool; stop() ends the workers
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+        logger.info(f"Started {self.workers} worker processes.")
+
+    def dispatch(self, raw_update):
+        """Hands an update (JSON text) to the worker of its user."""
+        update = json.loads(raw_update)
+        self._queues[get_worker_index(get_update_user_id(update), self.workers)].put(raw_update)
+
+    async def watch(self, interval=5):
+        """Restarts workers that died."""
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self._processes):
+                if not self._stopping and not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting.")
+                    self._start_worker(index)
+
+    async def poll(self, timeout=20):
+        """Long polls Telegram and dispatches the updates to the workers."""
+        offset = None
+        while True:
+            try:
+                updates = await asyncio_helper.get_updates(self.token, offset=offset, timeout=timeout, request_timeout=timeout + 10)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to get updates: {e}")
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.dispatch(json.dumps(update))
+
+    def stop(self, timeout=10):
+        self._stopping = True
+        for update_queue in self._queues:
+            update_queue.put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
@@ -0,0 +1,98 @@
+import ssl
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from telebot.types import Update
+from config import conf
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over HTTPS POSTs instead of long polling.
+
+    Each update is acknowledged right away and processed in a task; at most
+    `max_concurrent_updates` updates are processed at the same time, the others
+    wait for a free slot. Requests without the secret token are rejected.
+    With `dispatch`, updates are handed to it as JSON text instead (see supervisor.py).
+    """
+
+    def __init__(self, bot, path="/", secret_token=None, max_concurrent_updates=None, dispatch=None):
+        self.bot = bot
+        self.dispatch = dispatch
+        self.path = path
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self._semaphore = asyncio.Semaphore(max_concurrent_updates or conf.get("webhook_max_concurrent_updates", 64))
+        self._tasks = set()
+
+    async def handle(self, request):
+        if request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            logger.warning(f"Rejected webhook request from {request.remote}: bad secret token.")
+            return web.Response(status=403)
+        try:
+            raw_update = await request.text()
+            if self.dispatch is not None:
+                self.dispatch(raw_update)
+                return web.Response()
+            update = Update.de_json(raw_update)
+        except Exception as e:
+            logger.error(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        async with self._semaphore:
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception:
+                logger.error(f"Error processing update {update.update_id}", exc_info=True)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def run(self, url, listen="0.0.0.0", port=8443, certificate=None, private_key=None):
+        """
+        Registers the webhook at `url` with Telegram and serves updates until cancelled.
+        With `certificate` and `private_key`, the server speaks TLS itself and the
+        (self-signed) certificate is uploaded to Telegram; otherwise it expects a
+        reverse proxy terminating TLS in front of it.
+        """
+        ssl_context = None
+        if certificate and private_key:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(certificate, private_key)
+
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, listen, port, ssl_context=ssl_context)
+            await site.start()
+            logger.info(f"Webhook server listening on {listen}:{port}{self.path}")
+
+            cert_file = open(certificate, 'rb') if certificate else None
+            try:
+                await self.bot.set_webhook(
+                    url=url,
+                    certificate=cert_file,
+                    max_connections=conf.get("webhook_max_connections", 40),
+                    secret_token=self.secret_token,
+                )
+            finally:
+                if cert_file:
+                    cert_file.close()
+            logger.info(f"Webhook set to {url}")
+
+            await asyncio.Event().wait()
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            await runner.cleanup()